@@ -9,8 +9,33 @@ from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher.storage import BaseStorage, FSMContext
-import matplotlib.pyplot as plt
+from aiogram.utils.exceptions import MessageNotModified
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import io
+import hashlib
+import pickle
+import sqlite3
+import time
+import functools
+import itertools
+import tempfile
+import multiprocessing
+import re
+import html
+import bisect
+import json
+import struct
+import zlib
+import tracemalloc
+import weakref
+import gc
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import closing, asynccontextmanager
 import pandas as pd
 import numpy as np
 
@@ -85,6 +110,31 @@ API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 BINANCE_API_KEY = os.getenv('BINANCE_API_KEY')
 BINANCE_API_SECRET = os.getenv('BINANCE_API_SECRET')
 ALLOWED_USER_ID = int(os.getenv('ALLOWED_USER_ID'))
+# Каталог для локальных данных бота (кеши, снимки, истории)
+DATA_DIR = os.getenv('BOT_DATA_DIR', 'data')
+# Пары, для которых записываются снимки стакана (через запятую, например BTC/USDT,ETH/USDT), и период записи
+ORDER_BOOK_SYMBOLS = [symbol.strip().upper() for symbol in os.getenv('ORDER_BOOK_SYMBOLS', '').split(',')
+                      if symbol.strip()]
+ORDER_BOOK_INTERVAL = int(os.getenv('ORDER_BOOK_INTERVAL', 60))
+# Период записи истории стоимости портфеля в секундах (0 - не записывать)
+BALANCE_HISTORY_INTERVAL = int(os.getenv('BALANCE_HISTORY_INTERVAL', 300))
+# Получать изменения спотового аккаунта через user data stream (1) или только запросами REST (0)
+USER_DATA_STREAM = int(os.getenv('USER_DATA_STREAM', 1))
+# Пары, последние сделки по которым загружаются в память при подключении потока (через запятую)
+TRADE_HISTORY_SYMBOLS = [symbol.strip().upper() for symbol in os.getenv('TRADE_HISTORY_SYMBOLS', 'BTC/USDT').split(',')
+                         if symbol.strip()]
+# Период обновления каталога рынков в секундах и сколько монет (по объему) показывать в списках
+MARKETS_REFRESH_INTERVAL = int(os.getenv('MARKETS_REFRESH_INTERVAL', 3600))
+LISTED_COINS_LIMIT = int(os.getenv('LISTED_COINS_LIMIT', 20))
+# Период записи метрик бота в лог в секундах (0 - не записывать)
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', 300))
+# Контекст процессов для пулов рендера графиков и бэктестов. Рабочие функции пулов определены в этом модуле,
+# а его импорт создает бота и биржу, каталог данных и открывает хранилища, поэтому процессы пула должны
+# наследовать уже загруженный модуль через fork. При spawn и forkserver (Windows, macOS, Linux начиная
+# с Python 3.14) каждый процесс пула заново выполнял бы весь импорт модуля; fork на этих платформах
+# либо недоступен, либо не по умолчанию, поэтому выбирается явно, а без него остается контекст по умолчанию.
+WORKER_MP_CONTEXT = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods()
+                                                else None)
 
 # Инициализация MemoryStorage
 storage = SimpleDictStorage()
@@ -99,14 +149,86 @@ dp = Dispatcher(bot, storage=storage)
 dp.middleware.setup(LoggingMiddleware())
 
 # Инициализация подключения к бирже Binance
-exchange = ccxt.binance({
+class SingleFlightExchange:
+    """
+    Обертка над биржей ccxt, которая объединяет одинаковые одновременные запросы.
+
+    Вызовы методов из freshness с одинаковыми аргументами, пока первый еще выполняется, получают его
+    результат, а не отправляют новый запрос; готовый результат раздается еще freshness[метод] секунд.
+    Ошибки не запоминаются. Результат общий для всех ожидающих, поэтому изменять его нельзя.
+    Остальные атрибуты и методы берутся у биржи напрямую.
+    """
+
+    # Сколько секунд готовый ответ считается свежим (0 - только объединение одновременных запросов)
+    DEFAULT_FRESHNESS = {
+        'fetch_ticker': 2,
+        'fetch_tickers': 2,
+        'fetch_order_book': 1,
+        'fetch_ohlcv': 5,
+        'fetch_balance': 0,
+        'fetch_my_trades': 0,
+        'fetch_open_orders': 0,
+    }
+
+    def __init__(self, exchange, freshness=None):
+        self.exchange = exchange
+        self.freshness = dict(self.DEFAULT_FRESHNESS if freshness is None else freshness)
+        self.requests = 0
+        self.shared = 0
+        self._inflight = {}
+        self._methods = {}
+
+    def __getattr__(self, name):
+        # Вызывается только для атрибутов, которых нет у самой обертки
+        if name not in self.freshness:
+            return getattr(self.exchange, name)
+        if name not in self._methods:
+            self._methods[name] = functools.partial(self._call, name)
+        return self._methods[name]
+
+    async def _call(self, name, *args, **kwargs):
+        self.requests += 1
+        key = (name, json.dumps([args, kwargs], sort_keys=True, default=str))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(getattr(self.exchange, name)(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.shared += 1
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        ttl = self.freshness[key[0]]
+        if task.cancelled() or task.exception() is not None or not ttl:
+            self._expire(key, task)
+        else:
+            asyncio.get_running_loop().call_later(ttl, self._expire, key, task)
+
+    def _expire(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+
+exchange = SingleFlightExchange(ccxt.binance({
     'apiKey': BINANCE_API_KEY,
     'secret': BINANCE_API_SECRET,
     'enableRateLimit': True
-})
+}))
 
 user_alerts_status = {}
 
+# Правила разрешения бара, в котором задеты и стоп-лосс, и тейк-профит (см. MarketAnalysis.backtesting)
+INTRABAR_RULES = ('stop_first', 'target_first', 'nearest')
+
+# Сетка параметров combined_strategy для walk-forward оптимизации по умолчанию
+WALK_FORWARD_PARAM_GRID = {
+    'window_size': [14, 20, 30],
+    'rsi_thresholds': [(25, 75), (30, 70), (35, 65)],
+    'macd_threshold': [0, 0.001],
+}
+
 
 # Создание инлайн клавиатуры для меню
 menu = InlineKeyboardMarkup(row_width=2)
@@ -119,6 +241,8 @@ cancel_button = InlineKeyboardButton("Отмена", callback_data="cancel_actio
 menu.add(InlineKeyboardButton("Activate Alerts", callback_data="activate_alerts"))
 menu.add(InlineKeyboardButton("Deactivate Alerts", callback_data="deactivate_alerts"))
 menu.add(InlineKeyboardButton("Market Analysis", callback_data="market_analysis"))
+menu.add(InlineKeyboardButton("Backtest", callback_data="menu_backtest"))
+menu.add(InlineKeyboardButton("Dashboard", callback_data="menu_dashboard"))
 
 
 admin_id = 379834541  # Замените на ваш идентификатор пользователя в Telegram
@@ -126,9 +250,25 @@ admin_id = 379834541  # Замените на ваш идентификатор
 async def on_startup(dp):
     await bot.send_message(admin_id, "Бот запущен")
     asyncio.create_task(check_price_alerts())
+    if ORDER_BOOK_SYMBOLS:
+        recorder = OrderBookRecorder(exchange, os.path.join(DATA_DIR, 'orderbooks'), ORDER_BOOK_SYMBOLS,
+                                     interval=ORDER_BOOK_INTERVAL)
+        asyncio.create_task(recorder.run())
+    if BALANCE_HISTORY_INTERVAL:
+        asyncio.create_task(BalanceHistoryRecorder(balance_history, BALANCE_HISTORY_INTERVAL).run())
+    if USER_DATA_STREAM:
+        asyncio.create_task(user_data_stream.run())
+    asyncio.create_task(market_catalogue.run())
+    if METRICS_LOG_INTERVAL:
+        asyncio.create_task(log_metrics(METRICS_LOG_INTERVAL))
     # Отправляем приветственное сообщение
     await start_command(types.Message(chat=types.Chat(id=admin_id), from_user=types.User(id=admin_id)))
 
+async def on_shutdown(dp):
+    # Недописанный блок истории баланса сохраняется целиком, а не остается в журнале
+    balance_history.flush()
+
+
 # Функция для отображения меню после каждого запроса
 async def show_menu_after_request(message: types.Message):
     await message.answer("Выберите следующую команду из меню:", reply_markup=menu)
@@ -147,12 +287,15 @@ async def start_command(message: types.Message):
 async def help_command(message: types.Message):
     help_text = (
         "/balance - Показать ваш баланс на Binance.\n"
-        "/price - Показать текущую цену BTC.\n"
+        "/price [BTC,ETH,...] - Показать цены монет одной таблицей (по умолчанию BTC).\n"
         "/tradehistory - Показать историю ваших торгов.\n"
         "/clear - 'Очистить' чат.\n"
         "/setpricealert - Установить уведомление о цене.\n"
         "/activatealerts - Активировать уведомления.\n"
         "/deactivatealerts - Деактивировать уведомления.\n"
+        "/backtest - Проверить стратегию на исторических данных.\n"
+        "/dashboard - Показать сводку по всем монетам одним изображением.\n"
+        "/pnl [24h|7d|30d|1y|all] - Показать изменение стоимости портфеля за период.\n"
         "Выберите команду из меню или введите ее вручную:"
     )
     await message.answer(help_text, reply_markup=menu)
@@ -164,6 +307,91 @@ async def clear_chat(callback_query: types.CallbackQuery):
     await show_menu_after_request(callback_query.message)
     await callback_query.answer()
 
+class PerformanceMetrics:
+    """
+    Накопитель метрик эффективности торговли, который обновляется по одному значению капитала за раз.
+
+    Доходность, Sharpe, Sortino, максимальная просадка, доля прибыльных сделок и время в позиции считаются
+    онлайн (алгоритм Уэлфорда для дисперсии) с O(1) памяти, поэтому тот же накопитель подходит
+    и для бэктестинга, и для отслеживания реальной или бумажной торговли в реальном времени.
+    """
+
+    def __init__(self, periods_per_year=365):
+        self.periods_per_year = periods_per_year
+        self.initial_equity = None
+        self.equity = None
+        self.peak = None
+        self.max_drawdown = 0.0
+        self.bars = 0
+        self.bars_in_position = 0
+        self._returns = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._downside_sq = 0.0
+        self.trades = 0
+        self.winning_trades = 0
+        self.gross_profit = 0.0
+        self.gross_loss = 0.0
+
+    def update(self, equity, in_position=False):
+        """Учитывает капитал на очередном баре (или в очередной момент реальной торговли)."""
+        equity = float(equity)
+        self.bars += 1
+        self.bars_in_position += bool(in_position)
+        if self.equity is None:
+            self.initial_equity = self.peak = equity
+        else:
+            period_return = equity / self.equity - 1 if self.equity else 0.0
+            self._returns += 1
+            delta = period_return - self._mean
+            self._mean += delta / self._returns
+            self._m2 += delta * (period_return - self._mean)
+            self._downside_sq += min(period_return, 0.0) ** 2
+            self.peak = max(self.peak, equity)
+            if self.peak > 0:
+                self.max_drawdown = max(self.max_drawdown, 1 - equity / self.peak)
+        self.equity = equity
+
+    def record_trade(self, pnl):
+        """Учитывает результат закрытой сделки (прибыль или доходность)."""
+        self.trades += 1
+        if pnl > 0:
+            self.winning_trades += 1
+            self.gross_profit += pnl
+        else:
+            self.gross_loss -= pnl
+
+    def summary(self):
+        std = (self._m2 / (self._returns - 1)) ** 0.5 if self._returns > 1 else 0.0
+        downside = (self._downside_sq / self._returns) ** 0.5 if self._returns else 0.0
+        annualization = self.periods_per_year ** 0.5
+        return {
+            "total_return": self.equity / self.initial_equity - 1 if self.initial_equity else 0.0,
+            "sharpe": self._mean / std * annualization if std else 0.0,
+            "sortino": self._mean / downside * annualization if downside else 0.0,
+            "max_drawdown": self.max_drawdown,
+            "win_rate": self.winning_trades / self.trades if self.trades else 0.0,
+            # Без сделок коэффициент не определен; без убыточных сделок он бесконечен
+            "profit_factor": (self.gross_profit / self.gross_loss if self.gross_loss else float('inf'))
+            if self.trades else 0.0,
+            "exposure": self.bars_in_position / self.bars if self.bars else 0.0,
+            "trades": self.trades,
+        }
+
+
+def periods_per_year(index, default=365):
+    """Оценивает количество баров в году по шагу временного индекса (для годовых Sharpe и Sortino)."""
+    if isinstance(index, pd.DatetimeIndex) and len(index) > 1:
+        step = (index[-1] - index[0]) / (len(index) - 1)
+        if step > pd.Timedelta(0):
+            return pd.Timedelta(days=365) / step
+    return default
+
+
+class BacktestCancelled(Exception):
+    """Бэктест прерван через cancel_event."""
+
+
 class MarketAnalysisState(StatesGroup):
     CoinInput = State()  # Expecting a coin name as input
 
@@ -189,22 +417,37 @@ class MarketAnalysis:
         await MarketAnalysisState.CoinInput.set()
 
     async def analyze_specific_coin(self, message: types.Message, state: FSMContext):
-        coin_name = message.text.upper()  # Assuming coin names are in uppercase
+        await market_catalogue.ensure_loaded()
+        coin_name = market_catalogue.index.lookup(message.text)
+        await state.finish()  # Resetting the state
+        if coin_name is None:
+            # Неизвестная монета: предлагаем похожие вместо запроса к бирже. Состояние уже сброшено, чтобы
+            # команды и меню снова работали; новый ввод - через кнопку
+            query = message.text.strip().upper()
+            suggestions = market_catalogue.index.suggest(query)
+            markup = suggestion_keyboard(suggestions, 'suggest_analyze_')
+            markup.row(InlineKeyboardButton("Ввести другую монету", callback_data="analyze_specific_coin"))
+            markup.row(cancel_button)
+            text = (f"Монета {query} не найдена. Возможно, вы имели в виду:" if suggestions
+                    else f"Монета {query} не найдена.")
+            await self.bot.send_message(message.from_user.id, text, reply_markup=markup)
+            return
+        await self.send_recommendation(message.from_user.id, coin_name)
+
+    async def send_recommendation(self, user_id, coin_name):
         # Using the existing logic to analyze the coin
         best_timeframe = "1d"  # This can be changed based on your preference
         score, recommendation = await self.analyze_coin(coin_name, best_timeframe)
 
-        await self.bot.send_message(message.from_user.id, f"Рекомендация для {coin_name}: {recommendation}")
-        await state.finish()  # Resetting the state
-        await self.bot.send_message(message.from_user.id, "Выберите следующую команду из меню:", reply_markup=menu)
+        await self.bot.send_message(user_id, f"Рекомендация для {coin_name}: {recommendation}")
+        await self.bot.send_message(user_id, "Выберите следующую команду из меню:", reply_markup=menu)
 
     async def return_to_main_menu(self, callback_query: types.CallbackQuery):
         await self.bot.send_message(callback_query.from_user.id, "Выберите следующую команду из меню:", reply_markup=menu)
 
 
     async def perform_market_analysis(self):
-        coins = ["BTC", "ETH", "BNB", "ADA", "DOGE", "XRP", "DOT", "UNI", "BCH", "LTC", "LINK", "MATIC", "XLM", "ETC",
-                 "THETA", "VET", "TRX", "FIL", "XMR", "EOS"]
+        coins = await get_listed_coins()
         timeframes = ["5m", "15m", "30m", "1h", "4h", "1d"]
 
         best_coin = None
@@ -297,6 +540,16 @@ class MarketAnalysis:
         :param window: Период для RSI.
         :return: Последнее значение RSI.
         """
+        return self.compute_rsi_series(data, window).iloc[-1]
+
+    def compute_rsi_series(self, data, window=14):
+        """
+        Вычисляет RSI для каждой точки данных.
+
+        :param data: Ряд данных для вычисления RSI.
+        :param window: Период для RSI.
+        :return: Ряд RSI.
+        """
         delta = data.diff()
         gain = delta.where(delta > 0, 0).fillna(0)
         loss = -delta.where(delta < 0, 0).fillna(0)
@@ -305,9 +558,7 @@ class MarketAnalysis:
         avg_loss = self.compute_ema(loss, span=window)
 
         rs = avg_gain / avg_loss
-        rsi = 100 - (100 / (1 + rs))
-
-        return rsi.iloc[-1]
+        return 100 - (100 / (1 + rs))
 
     def compute_macd(self, data, short_window=12, long_window=26, signal_window=9):
         """
@@ -319,13 +570,25 @@ class MarketAnalysis:
         :param signal_window: Период сигнала для MACD.
         :return: Последнее значение гистограммы MACD.
         """
+        return self.compute_macd_series(data, short_window, long_window, signal_window)[2].iloc[-1]
+
+    def compute_macd_series(self, data, short_window=12, long_window=26, signal_window=9):
+        """
+        Вычисляет MACD для каждой точки данных.
+
+        :param data: Ряд данных для вычисления MACD.
+        :param short_window: Короткий период для MACD.
+        :param long_window: Длинный период для MACD.
+        :param signal_window: Период сигнала для MACD.
+        :return: Кортеж рядов: линия MACD, сигнальная линия, гистограмма.
+        """
         short_ema = self.compute_ema(data, short_window)
         long_ema = self.compute_ema(data, long_window)
         macd_line = short_ema - long_ema
         signal_line = self.compute_ema(macd_line, signal_window)
         histogram = macd_line - signal_line
 
-        return histogram.iloc[-1]
+        return macd_line, signal_line, histogram
 
     def analyze_data(self, data):
         """
@@ -346,63 +609,77 @@ class MarketAnalysis:
         else:
             return "Держать"
 
-    def compute_bollinger_bands(self, data, window=20, num_std=2, plot=False):
+    def analyze_data_signals(self, data):
+        """
+        Сигналы правила analyze_data (RSI + MACD) для каждого бара в формате, который принимает backtesting.
+
+        :param data: DataFrame с колонкой 'Close'.
+        :return: DataFrame с колонками 'Buy' и 'Sell' (1 - сигнал, 0 - нет сигнала).
+        """
+        rsi = self.compute_rsi_series(data['Close'])
+        macd_histogram = self.compute_macd_series(data['Close'])[2]
+        return pd.DataFrame({'Buy': ((rsi < 30) & (macd_histogram > 0)).astype(int),
+                             'Sell': ((rsi > 70) & (macd_histogram < 0)).astype(int)}, index=data.index)
+
+    def compute_bollinger_bands(self, data, window=20, num_std=2, plot=False, plot_format='png'):
         """
         Вычисляет Bollinger Bands для данных цен.
         Parameters:
         - data (pd.Series): Серия данных цен закрытия.
         - window (int): Размер окна для скользящей средней.
         - num_std (int): Количество стандартных отклонений для верхней и нижней ленты.
-        - plot (bool): Если True, отображает график.
+        - plot (bool): Если True, дополнительно возвращает график. Рендер идет в текущем процессе;
+          из обработчиков используйте plot_bollinger_bands.
+        - plot_format (str): Формат графика: 'png' или 'svg'.
         Returns:
-        - tuple: Верхняя лента, средняя лента (SMA), нижняя лента.
+        - tuple: Верхняя лента, средняя лента (SMA), нижняя лента и, если plot=True, график в байтах.
         """
         sma = data.rolling(window=window).mean()
         rolling_std = data.rolling(window=window).std()
         upper_band = sma + (rolling_std * num_std)
         lower_band = sma - (rolling_std * num_std)
         if plot:
-            plt.figure(figsize=(10, 6))
-            data.plot(label='Close Price')
-            upper_band.plot(label=f'Upper Band ({num_std} STD)', linestyle='--')
-            lower_band.plot(label=f'Lower Band ({num_std} STD)', linestyle='--')
-            sma.plot(label=f'SMA-{window}')
-            plt.title('Bollinger Bands')
-            plt.legend()
-            plt.show()
+            return upper_band, sma, lower_band, render_bollinger_bands(data, upper_band, sma, lower_band, window,
+                                                                       num_std, plot_format)
         return upper_band, sma, lower_band
 
-    def compute_stochastic_oscillator(self, data, window=14, smooth_window=3, plot=False):
+    async def plot_bollinger_bands(self, data, window=20, num_std=2, plot_format='png'):
+        """compute_bollinger_bands(plot=True) с рендером в пуле chart_service, не блокируя цикл событий."""
+        upper_band, sma, lower_band = self.compute_bollinger_bands(data, window, num_std)
+        image = await chart_service.render(render_bollinger_bands, data, upper_band, sma, lower_band, window,
+                                           num_std, plot_format)
+        return upper_band, sma, lower_band, image
+
+    def compute_stochastic_oscillator(self, data, window=14, smooth_window=3, plot=False, plot_format='png'):
         """
         Вычисляет Stochastic Oscillator для данных цен.
         Parameters:
         - data (pd.DataFrame): DataFrame с колонками 'Close', 'High' и 'Low'.
         - window (int): Размер окна для вычисления.
         - smooth_window (int): Размер окна для сглаживания %K для вычисления %D.
-        - plot (bool): Если True, отображает график.
+        - plot (bool): Если True, дополнительно возвращает график. Рендер идет в текущем процессе;
+          из обработчиков используйте plot_stochastic_oscillator.
+        - plot_format (str): Формат графика: 'png' или 'svg'.
         Returns:
-        - tuple: %K, %D.
+        - tuple: %K, %D и, если plot=True, график в байтах.
         """
         low_min = data['Low'].rolling(window=window).min()
         high_max = data['High'].rolling(window=window).max()
         k_percent = 100 * ((data['Close'] - low_min) / (high_max - low_min))
         d_percent = k_percent.rolling(window=smooth_window).mean()
         if plot:
-            plt.figure(figsize=(10, 6))
-            k_percent.plot(label='%K line')
-            d_percent.plot(label='%D line', linestyle='--')
-            plt.title('Stochastic Oscillator')
-            plt.legend()
-            plt.show()
+            return k_percent, d_percent, render_stochastic_oscillator(k_percent, d_percent, plot_format)
         return k_percent, d_percent
 
+    async def plot_stochastic_oscillator(self, data, window=14, smooth_window=3, plot_format='png'):
+        """compute_stochastic_oscillator(plot=True) с рендером в пуле chart_service."""
+        k_percent, d_percent = self.compute_stochastic_oscillator(data, window, smooth_window)
+        image = await chart_service.render(render_stochastic_oscillator, k_percent, d_percent, plot_format)
+        return k_percent, d_percent, image
 
-    def combined_strategy(self, data, window_size=20, rsi_thresholds=(30, 70), macd_threshold=0, plot=False):
-        # Проверяем, есть ли достаточно данных для расчета индикаторов
-        if len(data) < window_size:
-            return {"status": "error", "message": "Недостаточно данных"}
 
-        # Рассчитываем индикаторы MACD, RSI и Bollinger Bands
+    def _combined_indicators(self, data, window_size, rsi_thresholds, macd_threshold):
+        """Рассчитывает индикаторы MACD, RSI, Bollinger Bands и сигналы combined_strategy для каждого бара."""
         exp1 = data['Close'].ewm(span=12, adjust=False).mean()
         exp2 = data['Close'].ewm(span=26, adjust=False).mean()
         macd = exp1 - exp2
@@ -424,9 +701,100 @@ class MarketAnalysis:
         # Определяем сигналы для покупки и продажи на основе индикаторов
         buy_signal = (macd > signal + macd_threshold) & (rsi < rsi_thresholds[0]) & (data['Close'] < lower)
         sell_signal = (macd < signal - macd_threshold) & (rsi > rsi_thresholds[1]) & (data['Close'] > upper)
+        return macd, signal, rsi, upper, lower, buy_signal, sell_signal
+
+    def combined_strategy_signals(self, data, window_size=20, rsi_thresholds=(30, 70), macd_threshold=0):
+        """
+        Сигналы combined_strategy для каждого бара в формате, который принимает backtesting.
 
+        :return: DataFrame с колонками 'Buy' и 'Sell' (1 - сигнал, 0 - нет сигнала).
+        """
+        *_, buy_signal, sell_signal = self._combined_indicators(data, window_size, rsi_thresholds, macd_threshold)
+        return pd.DataFrame({'Buy': buy_signal.astype(int), 'Sell': sell_signal.astype(int)}, index=data.index)
+
+    def walk_forward_optimization(self, data, param_grid=None, train_size=500, test_size=100, max_workers=None,
+                                  **backtest_kwargs):
+        """
+        Walk-forward оптимизация параметров combined_strategy.
+
+        История делится на скользящие окна "обучение -> проверка". На каждом обучающем отрезке перебирается
+        сетка параметров, лучший набор (по прибыли backtesting) проверяется на следующем за ним отрезке.
+        Окна обрабатываются параллельно в отдельных процессах, которые читают свечи из общего
+        memory-mapped массива, а не получают копию DataFrame.
+
+        :param data: DataFrame со свечами ('Open', 'High', 'Low', 'Close', 'Volume').
+        :param param_grid: Словарь {параметр combined_strategy: список значений}.
+        :param train_size: Количество свечей в обучающем отрезке.
+        :param test_size: Количество свечей в проверочном отрезке (и шаг сдвига окна).
+        :param max_workers: Количество процессов, по умолчанию - все ядра.
+        :param backtest_kwargs: Дополнительные параметры backtesting (commission, stop_loss и т.д.).
+        :return: Словарь с результатами по окнам и итогами на проверочных отрезках.
+        """
+        if len(data) < train_size + test_size:
+            return {"status": "error", "message": "Недостаточно данных"}
+
+        grid = param_grid or WALK_FORWARD_PARAM_GRID
+        combinations = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+        windows = [(start, start + train_size, start + train_size + test_size)
+                   for start in range(0, len(data) - train_size - test_size + 1, test_size)]
+
+        # Свечи один раз пишутся в .npy файл, процессы открывают его через mmap без копирования
+        fd, path = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        try:
+            ohlcv = dataframe_to_ohlcv(data)
+            shared = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=ohlcv.shape)
+            shared[:] = ohlcv
+            shared.flush()
+            del shared
+
+            with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), mp_context=WORKER_MP_CONTEXT) as pool:
+                results = list(pool.map(_walk_forward_window, itertools.repeat(path), windows,
+                                        itertools.repeat(combinations), itertools.repeat(backtest_kwargs)))
+        finally:
+            os.remove(path)
+
+        test_profits = [window['test_profit'] for window in results]
+        return {
+            "status": "success",
+            "windows": results,
+            "total_test_profit": sum(test_profits),
+            "average_test_profit": sum(test_profits) / len(test_profits),
+            "profitable_windows": sum(profit > 0 for profit in test_profits) / len(test_profits),
+        }
+
+    def combined_strategy(self, data, window_size=20, rsi_thresholds=(30, 70), macd_threshold=0, plot=False,
+                          plot_format='png'):
+        # Проверяем, есть ли достаточно данных для расчета индикаторов
+        if len(data) < window_size:
+            return {"status": "error", "message": "Недостаточно данных"}
+
+        indicators = self._combined_indicators(data, window_size, rsi_thresholds, macd_threshold)
+        result = self._combined_result(data, indicators, rsi_thresholds, macd_threshold)
+
+        # Построим графики с индикаторами и сигналами для покупки и продажи, если параметр plot установлен в True.
+        # Рендер идет в текущем процессе; из обработчиков используйте plot_combined_strategy
+        if plot:
+            result["chart"] = render_combined_strategy(*self._combined_chart_args(data, indicators, rsi_thresholds),
+                                                       plot_format)
+
+        return result
+
+    async def plot_combined_strategy(self, data, window_size=20, rsi_thresholds=(30, 70), macd_threshold=0,
+                                     plot_format='png'):
+        """combined_strategy(plot=True) с рендером в пуле chart_service."""
+        if len(data) < window_size:
+            return {"status": "error", "message": "Недостаточно данных"}
+        indicators = self._combined_indicators(data, window_size, rsi_thresholds, macd_threshold)
+        result = self._combined_result(data, indicators, rsi_thresholds, macd_threshold)
+        result["chart"] = await chart_service.render(
+            render_combined_strategy, *self._combined_chart_args(data, indicators, rsi_thresholds), plot_format)
+        return result
+
+    def _combined_result(self, data, indicators, rsi_thresholds, macd_threshold):
+        macd, signal, rsi, upper, lower, buy_signal, sell_signal = indicators
         # Возвращаем результаты анализа в виде словаря
-        result = {
+        return {
             "status": "success",
             "recommendation": "Купить" if buy_signal.iloc[-1] else "Продать" if sell_signal.iloc[-1] else "Держать",
             "indicators": {
@@ -438,30 +806,10 @@ class MarketAnalysis:
             }
         }
 
-        # Построим графики с индикаторами и сигналами для покупки и продажи, если параметр plot установлен в True
-        if plot:
-            fig, ax = plt.subplots(3, 1, figsize=(12, 8))
-            ax[0].plot(data['Close'], label='Close Price')
-            ax[0].plot(upper, label='Upper Bollinger Band', linestyle='--')
-            ax[0].plot(lower, label='Lower Bollinger Band', linestyle='--')
-            ax[0].scatter(data.index[buy_signal], data['Close'][buy_signal], color='green', label='Buy Signal',
-                          marker='^')
-            ax[0].scatter(data.index[sell_signal], data['Close'][sell_signal], color='red', label='Sell Signal',
-                          marker='v')
-            ax[0].legend()
-
-            ax[1].plot(macd, label='MACD')
-            ax[1].plot(signal, label='Signal Line')
-            ax[1].legend()
-
-            ax[2].plot(rsi, label='RSI')
-            ax[2].axhline(y=rsi_thresholds[0], color='green', linestyle='--')
-            ax[2].axhline(y=rsi_thresholds[1], color='red', linestyle='--')
-            ax[2].legend()
-
-            plt.show()
-
-        return result
+    @staticmethod
+    def _combined_chart_args(data, indicators, rsi_thresholds):
+        macd, signal, rsi, upper, lower, buy_signal, sell_signal = indicators
+        return data['Close'], upper, lower, buy_signal, sell_signal, macd, signal, rsi, rsi_thresholds
 
     def adaptive_timeframes(self, data):
         # Вычисляем историческую волатильность (стандартное отклонение цен закрытия)
@@ -546,7 +894,31 @@ class MarketAnalysis:
             return "Держать"
 
     def backtesting(self, strategy, historical_data, initial_balance=100000, commission=0.001, trade_size=100,
-                    stop_loss=0.1, take_profit=0.2):
+                    stop_loss=0.1, take_profit=0.2, intrabar_rule='stop_first', slippage_model=None,
+                    cancel_event=None):
+        """
+        Проводит бэктестинг стратегии на исторических данных.
+
+        Стоп-лосс и тейк-профит проверяются внутри каждого бара по High/Low (если эти колонки есть в данных),
+        поэтому даже на крупных таймфреймах исполнение близко к реальному. Если за один бар задеты оба уровня,
+        порядок их срабатывания определяет intrabar_rule:
+        - 'stop_first' - первым срабатывает стоп-лосс (консервативная оценка);
+        - 'target_first' - первым срабатывает тейк-профит (оптимистичная оценка);
+        - 'nearest' - первым срабатывает уровень, ближайший к цене открытия бара.
+        Если бар открылся гэпом за уровнем, сделка закрывается по цене открытия.
+
+        :param strategy: Функция, возвращающая для данных колонки 'Buy' и 'Sell' (1 - сигнал).
+        :param historical_data: DataFrame с колонкой 'Close' и, по возможности, 'Open', 'High', 'Low'.
+        :param intrabar_rule: Правило разрешения бара, в котором задеты и стоп, и цель.
+        :param slippage_model: Модель проскальзывания (например, OrderBookSlippageModel). Без нее сделки
+            исполняются точно по цене бара.
+        :param cancel_event: Событие (threading/multiprocessing Event); если оно установлено, расчет
+            прерывается исключением BacktestCancelled.
+        :return: Словарь с прибылью, таблицей сделок по барам и списком закрытых сделок.
+        """
+        if intrabar_rule not in INTRABAR_RULES:
+            raise ValueError(f"Неизвестное правило intrabar_rule: {intrabar_rule}")
+
         # Проверяем, есть ли достаточно данных для бэктестинга
         if len(historical_data) < 2:
             return {"status": "error", "message": "Недостаточно данных"}
@@ -556,37 +928,90 @@ class MarketAnalysis:
 
         # Применяем стратегию к данным
         strategy_results = strategy(data)
-
-        # Создаем столбцы для хранения информации о покупках и продажах
-        data['Buy'] = 0
-        data['Sell'] = 0
-        data['Position'] = None
+        buy_signals = np.asarray(strategy_results['Buy'])
+        sell_signals = np.asarray(strategy_results['Sell'])
+
+        # Без High/Low бар сводится к цене закрытия, как в простой модели
+        closes = data['Close'].to_numpy(dtype=float)
+        opens = data['Open'].to_numpy(dtype=float) if 'Open' in data else closes
+        highs = data['High'].to_numpy(dtype=float) if 'High' in data else closes
+        lows = data['Low'].to_numpy(dtype=float) if 'Low' in data else closes
+        timestamps = index_to_milliseconds(data.index)
+
+        def fill(i, side, price):
+            if slippage_model is None:
+                return price
+            return slippage_model.fill_price(timestamps[i], side, price, trade_size)
+
+        # Создаем массивы для хранения информации о покупках и продажах
+        buys = np.zeros(len(data), dtype=int)
+        sells = np.zeros(len(data), dtype=int)
+        positions = [None] * len(data)
+        exit_prices = np.full(len(data), np.nan)
+        trades = []
 
         # Инициализируем переменные для хранения информации о позиции и балансе
         position = None
         balance = initial_balance
         entry_price = None
+        entry_index = None
 
         # Проходим по данным и выполняем торговлю на основе сигналов стратегии
+        equity = np.full(len(data), float(initial_balance))
+        metrics = PerformanceMetrics(periods_per_year(data.index))
+        metrics.update(float(initial_balance))
         for i in range(1, len(data)):
-            if strategy_results['Buy'][i] == 1 and position is None:
-                data['Position'][i] = 'Buy'
-                position = 'Buy'
-                entry_price = data['Close'][i]
-                balance -= entry_price * trade_size * (1 + commission)
-            elif strategy_results['Sell'][i] == 1 and position == 'Buy':
-                data['Position'][i] = 'Sell'
-                position = None
-                balance += data['Close'][i] * trade_size * (1 - commission)
-            elif position == 'Buy':
-                if data['Close'][i] <= entry_price * (1 - stop_loss):
-                    data['Position'][i] = 'Sell'
-                    position = None
-                    balance += data['Close'][i] * trade_size * (1 - commission)
-                elif data['Close'][i] >= entry_price * (1 + take_profit):
-                    data['Position'][i] = 'Sell'
+            # Проверка события - межпроцессный вызов, поэтому не на каждом баре
+            if cancel_event is not None and i % 1000 == 0 and cancel_event.is_set():
+                raise BacktestCancelled()
+            if position is None:
+                if buy_signals[i] == 1:
+                    buys[i] = 1
+                    positions[i] = 'Buy'
+                    position = 'Buy'
+                    entry_price = fill(i, 'buy', closes[i])
+                    entry_index = i
+                    balance -= entry_price * trade_size * (1 + commission)
+            else:
+                # Уровни задеваются внутри бара раньше, чем формируется сигнал по закрытию
+                exit_ = self._intrabar_exit(opens[i], highs[i], lows[i], entry_price * (1 - stop_loss),
+                                            entry_price * (1 + take_profit), intrabar_rule)
+                if exit_ is None and sell_signals[i] == 1:
+                    exit_ = (closes[i], 'signal')
+
+                if exit_ is not None:
+                    exit_price, reason = exit_
+                    exit_price = fill(i, 'sell', exit_price)
+                    sells[i] = 1
+                    positions[i] = 'Sell'
+                    exit_prices[i] = exit_price
                     position = None
-                    balance += data['Close'][i] * trade_size * (1 - commission)
+                    balance += exit_price * trade_size * (1 - commission)
+                    trades.append(self._closed_trade(data.index[entry_index], data.index[i], entry_price,
+                                                     exit_price, commission, reason))
+                    trades[-1]['profit'] = self._trade_profit(entry_price, exit_price, trade_size, commission)
+                    metrics.record_trade(trades[-1]['return'])
+
+            equity[i] = balance + (closes[i] * trade_size if position is not None else 0)
+            if i < len(data) - 1 or position is None:
+                metrics.update(equity[i], position is not None)
+
+        # Позиция, открытая к концу данных, закрывается по последней цене, иначе ее стоимость теряется в прибыли
+        if position is not None:
+            exit_price = fill(len(data) - 1, 'sell', closes[-1])
+            balance += exit_price * trade_size * (1 - commission)
+            equity[-1] = balance
+            trades.append(self._closed_trade(data.index[entry_index], data.index[-1], entry_price, exit_price,
+                                             commission, 'end_of_data'))
+            trades[-1]['profit'] = self._trade_profit(entry_price, exit_price, trade_size, commission)
+            metrics.record_trade(trades[-1]['return'])
+            metrics.update(balance, True)
+
+        data['Buy'] = buys
+        data['Sell'] = sells
+        data['Position'] = positions
+        data['ExitPrice'] = exit_prices
+        data['Equity'] = equity
 
         # Рассчитываем итоговую прибыль
         profit = balance - initial_balance
@@ -594,8 +1019,244 @@ class MarketAnalysis:
         # Возвращаем результаты бэктестинга
         return {
             "status": "success",
+            "initial_balance": initial_balance,
             "profit": profit,
-            "trades": data[['Close', 'Buy', 'Sell', 'Position']]
+            "trades": data[['Close', 'Buy', 'Sell', 'Position', 'ExitPrice', 'Equity']],
+            "closed_trades": trades,
+            "metrics": metrics.summary()
+        }
+
+    def portfolio_backtesting(self, strategy, data_by_symbol, initial_balance=100000, commission=0.001,
+                              risk_tolerance=0.02, stop_loss=0.1, take_profit=0.2, max_positions=None,
+                              intrabar_rule='stop_first'):
+        """
+        Бэктестинг стратегии сразу на нескольких монетах с общим балансом.
+
+        Свечи всех монет выравниваются по времени в матрицу "время x монеты", которая проходится один раз.
+        Свободные средства распределяются между одновременно открытыми позициями, размер каждой новой
+        позиции определяет risk_management от текущей стоимости портфеля. Стоп-лосс и тейк-профит
+        разрешаются внутри бара так же, как в backtesting.
+
+        :param strategy: Функция, возвращающая для данных монеты колонки 'Buy' и 'Sell'.
+        :param data_by_symbol: Словарь {монета: DataFrame со свечами}.
+        :param risk_tolerance: Доля портфеля на одну позицию (см. risk_management).
+        :param max_positions: Максимальное количество одновременно открытых позиций.
+        :return: Словарь с итогами портфеля, кривой капитала и результатами по каждой монете.
+        """
+        if intrabar_rule not in INTRABAR_RULES:
+            raise ValueError(f"Неизвестное правило intrabar_rule: {intrabar_rule}")
+        if not data_by_symbol or min(len(data) for data in data_by_symbol.values()) < 2:
+            return {"status": "error", "message": "Недостаточно данных"}
+
+        symbols = list(data_by_symbol)
+        index = functools.reduce(lambda left, right: left.union(right),
+                                 (data.index for data in data_by_symbol.values()))
+
+        def matrix(column, frames):
+            return pd.concat({symbol: frame[column] for symbol, frame in frames.items()}, axis=1) \
+                .reindex(index)[symbols].to_numpy(dtype=float)
+
+        signals = {symbol: strategy(data) for symbol, data in data_by_symbol.items()}
+        closes = matrix('Close', data_by_symbol)
+        opens = matrix('Open', data_by_symbol) if all('Open' in d for d in data_by_symbol.values()) else closes
+        highs = matrix('High', data_by_symbol) if all('High' in d for d in data_by_symbol.values()) else closes
+        lows = matrix('Low', data_by_symbol) if all('Low' in d for d in data_by_symbol.values()) else closes
+        buy_signals = np.nan_to_num(matrix('Buy', signals)) == 1
+        sell_signals = np.nan_to_num(matrix('Sell', signals)) == 1
+        # Для оценки портфеля монета без свечи в этот момент оценивается по последней известной цене
+        marks = np.nan_to_num(pd.DataFrame(closes).ffill().to_numpy())
+
+        cash = initial_balance
+        quantities = np.zeros(len(symbols))
+        costs = np.zeros(len(symbols))
+        entry_prices = np.full(len(symbols), np.nan)
+        entry_times = [None] * len(symbols)
+        equity = np.empty(len(index))
+        equity[0] = initial_balance
+        metrics = PerformanceMetrics(periods_per_year(index))
+        metrics.update(float(initial_balance))
+        trades = []
+
+        for t in range(1, len(index)):
+            # Выходы из открытых позиций
+            for s in np.flatnonzero(quantities):
+                if np.isnan(closes[t, s]):
+                    continue
+                exit_ = self._intrabar_exit(opens[t, s], highs[t, s], lows[t, s], entry_prices[s] * (1 - stop_loss),
+                                            entry_prices[s] * (1 + take_profit), intrabar_rule)
+                if exit_ is None and sell_signals[t, s]:
+                    exit_ = (closes[t, s], 'signal')
+                if exit_ is not None:
+                    proceeds = quantities[s] * exit_[0] * (1 - commission)
+                    cash += proceeds
+                    trade = self._closed_trade(entry_times[s], index[t], entry_prices[s], exit_[0], commission,
+                                               exit_[1])
+                    trade.update(symbol=symbols[s], profit=float(proceeds - costs[s]))
+                    trades.append(trade)
+                    metrics.record_trade(trade['profit'])
+                    quantities[s] = 0
+
+            # Входы в новые позиции из общего баланса
+            portfolio_value = cash + quantities @ marks[t]
+            for s in np.flatnonzero(buy_signals[t] & (quantities == 0) & ~np.isnan(closes[t])):
+                if max_positions is not None and np.count_nonzero(quantities) >= max_positions:
+                    break
+                amount = min(self.risk_management(1, portfolio_value, risk_tolerance), cash)
+                if amount <= 0:
+                    break
+                quantities[s] = amount / (closes[t, s] * (1 + commission))
+                costs[s] = amount
+                entry_prices[s] = closes[t, s]
+                entry_times[s] = index[t]
+                cash -= amount
+
+            equity[t] = cash + quantities @ marks[t]
+            if t < len(index) - 1:
+                metrics.update(equity[t], quantities.any())
+
+        # Позиции, открытые к концу данных, закрываются по последней известной цене
+        for s in np.flatnonzero(quantities):
+            proceeds = quantities[s] * marks[-1, s] * (1 - commission)
+            cash += proceeds
+            trade = self._closed_trade(entry_times[s], index[-1], entry_prices[s], marks[-1, s], commission,
+                                       'end_of_data')
+            trade.update(symbol=symbols[s], profit=float(proceeds - costs[s]))
+            trades.append(trade)
+            metrics.record_trade(trade['profit'])
+        metrics.update(cash, bool(trades) and trades[-1]['reason'] == 'end_of_data')
+        equity[-1] = cash
+
+        per_symbol = {}
+        for symbol in symbols:
+            symbol_trades = [trade for trade in trades if trade['symbol'] == symbol]
+            per_symbol[symbol] = {
+                "profit": sum(trade['profit'] for trade in symbol_trades),
+                "trades": len(symbol_trades),
+                "win_rate": (sum(trade['profit'] > 0 for trade in symbol_trades) / len(symbol_trades)
+                             if symbol_trades else 0.0),
+            }
+
+        return {
+            "status": "success",
+            "initial_balance": initial_balance,
+            "profit": cash - initial_balance,
+            "final_balance": cash,
+            "equity": pd.Series(equity, index=index),
+            "symbols": per_symbol,
+            "closed_trades": trades,
+            "metrics": metrics.summary()
+        }
+
+    def _closed_trade(self, entry_time, exit_time, entry_price, exit_price, commission, reason):
+        """Описание закрытой сделки для результатов бэктестинга."""
+        return {
+            "entry_time": entry_time,
+            "exit_time": exit_time,
+            "entry_price": float(entry_price),
+            "exit_price": float(exit_price),
+            "return": float(exit_price * (1 - commission) / (entry_price * (1 + commission)) - 1),
+            "reason": reason,
+        }
+
+    def _trade_profit(self, entry_price, exit_price, trade_size, commission):
+        """Прибыль сделки фиксированного объема trade_size с учетом комиссии на входе и выходе."""
+        return float((exit_price * (1 - commission) - entry_price * (1 + commission)) * trade_size)
+
+    def cached_backtesting(self, strategy, historical_data, symbol, timeframe, store=None, cancel_event=None,
+                           **params):
+        """
+        backtesting с сохранением результата в локальном хранилище.
+
+        Повторный запуск той же стратегии с теми же параметрами на тех же свечах возвращает сохраненный
+        результат без пересчета. Результат пересчитывается, только если изменились сами свечи.
+
+        :param symbol: Торговая пара, например 'BTC/USDT'.
+        :param timeframe: Таймфрейм свечей, например '1h'.
+        :param store: Хранилище результатов, по умолчанию - backtest_store.
+        :param cancel_event: Событие отмены для backtesting (не входит в ключ).
+        :param params: Параметры backtesting.
+        """
+        store = store or backtest_store
+        key = store.make_key((self.backtesting, strategy), params, symbol, timeframe,
+                             historical_data.index[0], historical_data.index[-1])
+        fingerprint = store.candles_fingerprint(historical_data)
+        result = store.get(key, fingerprint)
+        if result is None:
+            result = self.backtesting(strategy, historical_data, cancel_event=cancel_event, **params)
+            if result['status'] == 'success':
+                store.put(key, symbol, timeframe, fingerprint, result)
+        return result
+
+    def _intrabar_exit(self, bar_open, high, low, stop_price, target_price, intrabar_rule):
+        """
+        Определяет, сработал ли внутри бара стоп-лосс или тейк-профит.
+
+        :return: Кортеж (цена исполнения, причина) или None, если ни один уровень не задет.
+        """
+        # Гэп за уровень исполняется по цене открытия
+        if bar_open <= stop_price:
+            return bar_open, 'stop_loss'
+        if bar_open >= target_price:
+            return bar_open, 'take_profit'
+
+        stop_hit = low <= stop_price
+        target_hit = high >= target_price
+        if stop_hit and target_hit:
+            if intrabar_rule == 'target_first':
+                stop_hit = False
+            elif intrabar_rule == 'nearest':
+                stop_hit = bar_open - stop_price <= target_price - bar_open
+        if stop_hit:
+            return stop_price, 'stop_loss'
+        if target_hit:
+            return target_price, 'take_profit'
+        return None
+
+    def monte_carlo_analysis(self, backtest_result, n_simulations=10000, method='bootstrap', seed=None):
+        """
+        Monte Carlo анализ устойчивости результатов бэктестинга.
+
+        Прибыль каждой закрытой сделки берется как доля начального баланса и многократно перемешивается
+        ('shuffle') или выбирается с возвращением ('bootstrap'), все симуляции считаются одной операцией
+        над двумерным массивом "симуляции x сделки". Доли складываются, а не перемножаются: сделки
+        backtesting и portfolio_backtesting используют только часть капитала, а не реинвестируют его весь.
+        При перемешивании итоговая доходность одинакова во всех симуляциях, меняется только просадка.
+
+        :param backtest_result: Результат backtesting или portfolio_backtesting.
+        :param n_simulations: Количество симуляций.
+        :param method: 'bootstrap' или 'shuffle'.
+        :param seed: Зерно генератора случайных чисел для воспроизводимости.
+        :return: Словарь с распределениями итоговой доходности и максимальной просадки.
+        """
+        initial_balance = backtest_result['initial_balance']
+        returns = np.array([trade['profit'] / initial_balance for trade in backtest_result.get('closed_trades', [])],
+                           dtype=float)
+        if len(returns) == 0:
+            return {"status": "error", "message": "Нет закрытых сделок"}
+
+        rng = np.random.default_rng(seed)
+        if method == 'bootstrap':
+            samples = returns[rng.integers(0, len(returns), size=(n_simulations, len(returns)))]
+        elif method == 'shuffle':
+            samples = rng.permuted(np.tile(returns, (n_simulations, 1)), axis=1)
+        else:
+            raise ValueError(f"Неизвестный метод Monte Carlo: {method}")
+
+        equity = 1 + np.cumsum(samples, axis=1)
+        peaks = np.maximum(np.maximum.accumulate(equity, axis=1), 1)
+        max_drawdowns = (1 - equity / peaks).max(axis=1)
+        final_returns = equity[:, -1] - 1
+
+        percentiles = (5, 25, 50, 75, 95)
+        return {
+            "status": "success",
+            "method": method,
+            "simulations": n_simulations,
+            "trades": len(returns),
+            "expected_return": float(final_returns.mean()),
+            "probability_of_loss": float((final_returns < 0).mean()),
+            "return_percentiles": dict(zip(percentiles, np.percentile(final_returns, percentiles).tolist())),
+            "max_drawdown_percentiles": dict(zip(percentiles, np.percentile(max_drawdowns, percentiles).tolist())),
         }
 
     def risk_management(self, recommendation, account_balance, risk_tolerance=0.02):
@@ -613,17 +1274,18 @@ class MarketAnalysis:
             return 'minute'
 
     # Пользовательский интерфейс
-    def generate_visual_report(self, data, indicators=['SMA', 'EMA']):
-        plt.figure(figsize=(12, 6))
-        plt.plot(data['Close'], label='Close Price')
-        for indicator in indicators:
-            if indicator in data.columns:
-                plt.plot(data[indicator], label=indicator)
-        plt.legend()
-        plt.title('Market Analysis Report')
-        plt.xlabel('Date')
-        plt.ylabel('Price')
-        plt.show()
+    def generate_visual_report(self, data, indicators=['SMA', 'EMA'], plot_format='png'):
+        """
+        Строит отчет с ценой закрытия и индикаторами из колонок data.
+        Рендер идет в текущем процессе; из обработчиков используйте plot_visual_report.
+
+        :return: График в байтах ('png' или 'svg').
+        """
+        return render_visual_report(data, indicators, plot_format)
+
+    async def plot_visual_report(self, data, indicators=['SMA', 'EMA'], plot_format='png'):
+        """generate_visual_report с рендером в пуле chart_service."""
+        return await chart_service.render(render_visual_report, data, indicators, plot_format)
 
     # Интеграция с новостными источниками
     def integrate_news_sources(self):
@@ -636,6 +1298,321 @@ class MarketAnalysis:
         pass
 
 
+def ohlcv_to_dataframe(ohlcv):
+    """Преобразует свечи в формате ccxt ([время в мс, open, high, low, close, volume]) в DataFrame."""
+    rows = np.asarray(ohlcv, dtype=float).reshape(-1, 6)
+    data = pd.DataFrame(rows[:, 1:], columns=['Open', 'High', 'Low', 'Close', 'Volume'],
+                        index=pd.to_datetime(rows[:, 0].astype('int64'), unit='ms'))
+    data.index.name = 'Time'
+    return data
+
+
+def dataframe_to_ohlcv(data):
+    """Обратное к ohlcv_to_dataframe преобразование: DataFrame -> массив float64 формы (n, 6)."""
+    return np.column_stack([index_to_milliseconds(data.index),
+                            data[['Open', 'High', 'Low', 'Close', 'Volume']].to_numpy(dtype=float)])
+
+
+def index_to_milliseconds(index):
+    """Время свечей в миллисекундах (как в ccxt) для временного или числового индекса."""
+    if isinstance(index, pd.DatetimeIndex):
+        return index.as_unit('ms').asi8
+    return np.asarray(index, dtype=float)
+
+
+def order_book_dtype(depth):
+    """Формат одной записи снимка стакана: время и depth уровней [цена, объем] для bids и asks."""
+    return np.dtype([('timestamp', '<i8'), ('bids', '<f8', (depth, 2)), ('asks', '<f8', (depth, 2))])
+
+
+def order_book_path(directory, symbol, depth):
+    return os.path.join(directory, f"{symbol.replace('/', '_')}.depth{depth}.bin")
+
+
+class OrderBookRecorder:
+    """
+    Периодически сохраняет снимки стакана (fetch_order_book) в бинарные файлы, по файлу на пару.
+
+    Записи имеют фиксированный размер (order_book_dtype), файл только дописывается и читается
+    целиком через numpy без разбора, поэтому снимки можно воспроизводить офлайн.
+    """
+
+    def __init__(self, exchange, directory, symbols, depth=20, interval=60):
+        self.exchange = exchange
+        self.directory = directory
+        self.symbols = symbols
+        self.depth = depth
+        self.interval = interval
+        self.dtype = order_book_dtype(depth)
+        os.makedirs(directory, exist_ok=True)
+
+    async def record(self, symbol):
+        order_book = await self.exchange.fetch_order_book(symbol, limit=self.depth)
+        record = np.zeros(1, dtype=self.dtype)
+        record['timestamp'] = order_book['timestamp'] or self.exchange.milliseconds()
+        # Недостающие уровни остаются нулевыми и при чтении пропускаются
+        for side in ('bids', 'asks'):
+            levels = [level[:2] for level in order_book[side][:self.depth]]
+            if levels:
+                record[side][0, :len(levels)] = levels
+        with open(order_book_path(self.directory, symbol, self.depth), 'ab') as file:
+            file.write(record.tobytes())
+
+    async def run(self):
+        while True:
+            results = await asyncio.gather(*(self.record(symbol) for symbol in self.symbols), return_exceptions=True)
+            for symbol, result in zip(self.symbols, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Ошибка при записи стакана {symbol}: {result}")
+            await asyncio.sleep(self.interval)
+
+
+class OrderBookSlippageModel:
+    """
+    Модель проскальзывания по записанным снимкам стакана.
+
+    Для сделки берется последний снимок не позже ее времени, объем сделки "проходит" по уровням стакана,
+    и относительное отклонение средней цены исполнения от середины спреда переносится на цену бара.
+    Поиск снимка - бинарный поиск по времени, поэтому запрос на каждом баре стоит O(log n).
+    Сделки до начала записи и сделки, для которых последний снимок старше max_age мс, исполняются
+    без проскальзывания: чужой стакан для них ничего не говорит.
+    """
+
+    def __init__(self, path, depth=20, max_age=24 * 60 * 60 * 1000):
+        self.path = path
+        self.max_age = max_age
+        self.snapshots = np.fromfile(path, dtype=order_book_dtype(depth))
+        self.timestamps = self.snapshots['timestamp']
+
+    @classmethod
+    def for_symbol(cls, directory, symbol, depth=20, **kwargs):
+        """Модель по записям OrderBookRecorder для пары или None, если записей нет."""
+        path = order_book_path(directory, symbol, depth)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        return cls(path, depth, **kwargs)
+
+    def __repr__(self):
+        # Используется в ключе BacktestResultStore: новые снимки меняют модель и, значит, результат
+        last = self.timestamps[-1] if len(self.timestamps) else None
+        return (f"OrderBookSlippageModel({self.path!r}, snapshots={len(self.timestamps)}, last={last}, "
+                f"max_age={self.max_age})")
+
+    def slippage(self, timestamp, side, notional):
+        """
+        Относительное проскальзывание сделки объемом notional (в котируемой валюте).
+
+        :param side: 'buy' (исполнение по asks) или 'sell' (по bids).
+        :return: Отношение средней цены исполнения к середине спреда минус 1.
+        """
+        i = int(np.searchsorted(self.timestamps, timestamp, side='right')) - 1
+        if i < 0 or timestamp - self.timestamps[i] > self.max_age:
+            return 0.0
+        snapshot = self.snapshots[i]
+        bids = snapshot['bids'][snapshot['bids'][:, 1] > 0]
+        asks = snapshot['asks'][snapshot['asks'][:, 1] > 0]
+        if not len(bids) or not len(asks):
+            return 0.0
+        mid = (bids[0, 0] + asks[0, 0]) / 2
+        levels = asks if side == 'buy' else bids
+
+        # Объем в базовой валюте по цене снимка; все, что глубже записанных уровней, исполняется по последнему
+        quantity = notional / mid
+        filled_before = np.cumsum(levels[:, 1]) - levels[:, 1]
+        taken = np.clip(quantity - filled_before, 0, levels[:, 1])
+        rest = max(quantity - taken.sum(), 0)
+        average_price = (taken @ levels[:, 0] + rest * levels[-1, 0]) / quantity
+        return average_price / mid - 1
+
+    def fill_price(self, timestamp, side, price, quantity):
+        """Цена исполнения сделки объемом quantity (в базовой валюте) по цене бара price."""
+        return price * (1 + self.slippage(timestamp, side, price * quantity))
+
+
+def _walk_forward_window(path, window, combinations, backtest_kwargs):
+    """Обрабатывает одно окно walk-forward оптимизации в процессе-исполнителе."""
+    train_start, test_start, test_end = window
+    ohlcv = np.load(path, mmap_mode='r')
+    analyzer = MarketAnalysis(None, None)
+
+    train = ohlcv_to_dataframe(ohlcv[train_start:test_start])
+    best_params, best_profit = combinations[0], -float('inf')
+    for params in combinations:
+        result = analyzer.backtesting(functools.partial(analyzer.combined_strategy_signals, **params), train,
+                                      **backtest_kwargs)
+        if result['status'] == 'success' and result['profit'] > best_profit:
+            best_params, best_profit = params, result['profit']
+
+    # Индикаторы на проверочном отрезке прогреваются на обучающей истории, но сделки открываются только в нем
+    def test_strategy(data):
+        signals = analyzer.combined_strategy_signals(data, **best_params)
+        signals.iloc[:test_start - train_start] = 0
+        return signals
+
+    test = analyzer.backtesting(test_strategy, ohlcv_to_dataframe(ohlcv[train_start:test_end]), **backtest_kwargs)
+    return {
+        "train": (train_start, test_start),
+        "test": (test_start, test_end),
+        "params": best_params,
+        "train_profit": best_profit,
+        "test_profit": test['profit'],
+        "test_trades": len(test['closed_trades']),
+    }
+
+
+class BacktestResultStore:
+    """
+    Хранилище результатов бэктестинга в SQLite.
+
+    Ключ - хеш кода стратегии и движка (вместе со значениями по умолчанию, замыканиями и вызываемыми
+    функциями и классами модуля), параметров, пары, таймфрейма, диапазона свечей и STORE_VERSION.
+    Вместе с результатом хранится отпечаток самих свечей: запись считается устаревшей,
+    только если свечи в том же диапазоне изменились.
+
+    Диапазон свечей сдвигается с каждой новой свечой, поэтому записи копятся: при сохранении удаляются
+    записи старше max_age секунд и все, кроме max_per_series последних, для пары и таймфрейма.
+    """
+
+    # Увеличивается при изменениях движка, которые меняют результат, но не видны в хеше кода
+    STORE_VERSION = 2
+
+    def __init__(self, path, max_age=30 * 24 * 60 * 60, max_per_series=20):
+        self.path = path
+        self.max_age = max_age
+        self.max_per_series = max_per_series
+        self._initialized = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        if not self._initialized:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS backtests ("
+                "key TEXT PRIMARY KEY, symbol TEXT, timeframe TEXT, candles_hash TEXT, "
+                "created_at REAL, result BLOB)")
+            self._initialized = True
+        return connection
+
+    @staticmethod
+    def make_key(strategy, params, symbol, timeframe, start, end):
+        digest = hashlib.sha256()
+        digest.update(f"v{BacktestResultStore.STORE_VERSION}".encode())
+        _digest_callable(strategy, digest, set())
+        digest.update(repr(sorted(params.items())).encode())
+        digest.update(f"{symbol}|{timeframe}|{start}|{end}".encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def candles_fingerprint(data):
+        return hashlib.sha256(np.ascontiguousarray(dataframe_to_ohlcv(data)).tobytes()).hexdigest()
+
+    def get(self, key, fingerprint):
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT candles_hash, result FROM backtests WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        return pickle.loads(row[1])
+
+    def put(self, key, symbol, timeframe, fingerprint, result):
+        with closing(self._connect()) as connection, connection:
+            connection.execute("INSERT OR REPLACE INTO backtests VALUES (?, ?, ?, ?, ?, ?)",
+                               (key, symbol, timeframe, fingerprint, time.time(), pickle.dumps(result)))
+            self._prune(connection, symbol, timeframe)
+
+    def _prune(self, connection, symbol, timeframe):
+        connection.execute("DELETE FROM backtests WHERE created_at < ?", (time.time() - self.max_age,))
+        connection.execute(
+            "DELETE FROM backtests WHERE symbol = ? AND timeframe = ? AND key NOT IN ("
+            "SELECT key FROM backtests WHERE symbol = ? AND timeframe = ? ORDER BY created_at DESC LIMIT ?)",
+            (symbol, timeframe, symbol, timeframe, self.max_per_series))
+
+
+def _digest_callable(func, digest, seen):
+    """
+    Добавляет в хеш все, от чего зависит результат функции: байткод, значения по умолчанию, содержимое
+    замыканий, методы того же объекта, вызываемые через self, и функции, классы и константы модуля,
+    к которым она обращается по имени.
+    """
+    if isinstance(func, (tuple, list)):
+        for item in func:
+            _digest_callable(item, digest, seen)
+        return
+    if isinstance(func, functools.partial):
+        _digest_value((func.args, sorted(func.keywords.items())), digest, seen)
+        _digest_callable(func.func, digest, seen)
+        return
+    if isinstance(func, type):
+        if func in seen:
+            return
+        seen.add(func)
+        for name, member in sorted(vars(func).items()):
+            if callable(member) and hasattr(member, '__code__'):
+                _digest_callable(member, digest, seen)
+        return
+    owner = getattr(func, '__self__', None)
+    function = getattr(func, '__func__', func)
+    code = getattr(function, '__code__', None)
+    if code is None or code in seen:
+        return
+    seen.add(code)
+    _digest_code(code, digest)
+    _digest_value(getattr(function, '__defaults__', None), digest, seen)
+    _digest_value(sorted((getattr(function, '__kwdefaults__', None) or {}).items()), digest, seen)
+    for cell in getattr(function, '__closure__', None) or ():
+        try:
+            _digest_value(cell.cell_contents, digest, seen)
+        except ValueError:
+            # Пустая ячейка (переменная замыкания еще не присвоена)
+            digest.update(b'<empty>')
+    module_globals = getattr(function, '__globals__', {})
+    for name in _code_names(code):
+        # Методы, вызываемые через self, тоже входят в ключ: их изменение меняет результат стратегии
+        if owner is not None:
+            method = getattr(type(owner), name, None)
+            if callable(method) and hasattr(method, '__code__'):
+                _digest_callable(getattr(owner, name), digest, seen)
+        value = module_globals.get(name)
+        if getattr(value, '__module__', None) == function.__module__ and (
+                isinstance(value, type) or hasattr(value, '__code__')):
+            _digest_callable(value, digest, seen)
+        elif isinstance(value, (int, float, str, bytes, tuple, frozenset, dict)):
+            _digest_value(value, digest, seen)
+
+
+def _code_names(code):
+    """Имена из co_names функции и вложенных в нее функций и выражений."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            names.update(_code_names(const))
+    return sorted(names)
+
+
+def _digest_value(value, digest, seen):
+    """Хеширует значение; функции - по коду, а не по repr с адресом в памяти."""
+    if hasattr(value, '__code__') or isinstance(value, (functools.partial, type)) or hasattr(value, '__func__'):
+        _digest_callable(value, digest, seen)
+    elif isinstance(value, (tuple, list)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _digest_value(item, digest, seen)
+    else:
+        digest.update(repr(value).encode())
+
+
+def _digest_code(code, digest):
+    digest.update(code.co_code)
+    digest.update(' '.join(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            _digest_code(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+
+os.makedirs(DATA_DIR, exist_ok=True)
+backtest_store = BacktestResultStore(os.path.join(DATA_DIR, 'backtests.sqlite3'))
+
+
 # Создайте экземпляр класса
 market_analyzer = MarketAnalysis(bot, exchange)
 
@@ -648,10 +1625,18 @@ async def market_analysis_callback_handler(callback_query: types.CallbackQuery,
 async def analyze_specific_coin_handler(callback_query: types.CallbackQuery, state: FSMContext):
     await market_analyzer.ask_for_coin(callback_query, state)
 
-@dp.message_handler(state=MarketAnalysisState.CoinInput)
+# "Отмена" обрабатывает cancel_text
+@dp.message_handler(lambda message: message.text.lower() != 'отмена', state=MarketAnalysisState.CoinInput)
 async def coin_input_handler(message: types.Message, state: FSMContext):
     await market_analyzer.analyze_specific_coin(message, state)
 
+@dp.callback_query_handler(lambda c: c.data.startswith("suggest_analyze_"), state="*")
+async def suggested_coin_analysis_handler(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.finish()
+    await callback_query.answer()
+    await market_analyzer.send_recommendation(callback_query.from_user.id,
+                                              callback_query.data[len("suggest_analyze_"):])
+
 @dp.callback_query_handler(lambda c: c.data == "return_to_menu", state="*")
 async def return_to_menu_handler(callback_query: types.CallbackQuery, state: FSMContext):
     await market_analyzer.return_to_main_menu(callback_query)
@@ -659,30 +1644,14 @@ async def return_to_menu_handler(callback_query: types.CallbackQuery, state: FSM
 @dp.callback_query_handler(lambda c: c.data == 'menu_balance')
 async def get_balance(callback_query: types.CallbackQuery):
     try:
-        # Типы кошельков на Binance
-        wallet_types = ['spot', 'margin', 'futures']
-
-        async def fetch_wallet_balance(wallet_type):
-            balance = await exchange.fetch_balance({'type': wallet_type})
-            usdt_balance = balance['total'].get('USDT', 0)
-            traded_coins = {coin: amount for coin, amount in balance['total'].items() if coin != 'USDT' and amount > 0}
-            response = [f"\n🔹 Кошелек {wallet_type.capitalize()} 🔹", f"Баланс: {usdt_balance:.2f} USDT"]
-            if traded_coins:
-                for coin, amount in traded_coins.items():
-                    ticker = await exchange.fetch_ticker(f'{coin}/USDT')
-                    coin_value_usdt = ticker['last'] * amount
-                    percentage = (coin_value_usdt / (coin_value_usdt + usdt_balance)) * 100
-                    response.append(f"Торгуется {coin_value_usdt:.2f} USDT в {coin} ({percentage:.2f}%)")
-            else:
-                response.append("Не торгуется депозитом данного кошелька.")
-            return response
-
-        responses = await asyncio.gather(*(fetch_wallet_balance(wallet) for wallet in wallet_types))
+        wallets, prices = await fetch_portfolio()
 
         # Объединяем все ответы в один список
         all_responses = ["Ваши балансы:"]
-        for response in responses:
-            all_responses.extend(response)
+        for wallet_type, totals in wallets:
+            all_responses.extend(format_wallet_balance(wallet_type, totals, prices))
+        total = sum(portfolio_values(wallets, prices).values())
+        all_responses.append(f"\nИтого по всем кошелькам: {total:.2f} USDT")
 
         await callback_query.message.answer("\n".join(all_responses))
         await show_menu_after_request(callback_query.message)
@@ -692,24 +1661,1445 @@ async def get_balance(callback_query: types.CallbackQuery):
     await callback_query.answer()
 
 
+class BalanceSnapshotCache:
+    """
+    Снимки балансов кошельков с коротким TTL.
+
+    fetch_balance - тяжелый по весу запрос, а нажатие "Balance" делает его для трех кошельков сразу.
+    Снимок сбрасывается досрочно через invalidate(), как только бот видит новую сделку: баланс после
+    нее уже другой. Снимок, запрошенный до сброса, в кеш не попадает.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._snapshots = {}
+        self._generation = 0
+        self._last_trade_ids = set()
+
+    async def get(self, wallet_type, fetch):
+        snapshot = self._snapshots.get(wallet_type)
+        if snapshot is not None and time.monotonic() - snapshot['created'] <= self.ttl:
+            return snapshot['totals']
+        generation = self._generation
+        totals = await fetch(wallet_type)
+        if generation == self._generation:
+            self._snapshots[wallet_type] = {"totals": totals, "created": time.monotonic()}
+        return totals
+
+    def invalidate(self, wallet_type=None):
+        if wallet_type is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(wallet_type, None)
+        self._generation += 1
+
+    def observe_trades(self, trades):
+        """Сбрасывает снимки, если среди последних сделок появились еще не виденные."""
+        trade_ids = {trade['id'] for trade in trades}
+        if trade_ids - self._last_trade_ids:
+            self.invalidate()
+        self._last_trade_ids = trade_ids
+
+
+balance_cache = BalanceSnapshotCache(ttl=int(os.getenv('BALANCE_CACHE_TTL', 30)))
+
+
+# Типы кошельков на Binance
+WALLET_TYPES = ['spot', 'margin', 'futures']
+
+
+async def fetch_portfolio():
+    """Балансы всех кошельков и цены всех монет в USDT (одним запросом тикеров)."""
+    wallets = await asyncio.gather(*(fetch_wallet_balance(wallet) for wallet in WALLET_TYPES))
+    coins = {coin for _, totals in wallets for coin, amount in totals.items() if coin != 'USDT' and amount > 0}
+    prices = await valuation_engine.prices(coins)
+    return wallets, prices
+
+
+def portfolio_values(wallets, prices):
+    """Стоимость каждого актива в USDT по всем кошелькам; активы без оценки не учитываются."""
+    values = {}
+    for _, totals in wallets:
+        for coin, amount in totals.items():
+            price = 1.0 if coin == 'USDT' else prices.get(coin)
+            if amount > 0 and price is not None:
+                values[coin] = values.get(coin, 0.0) + amount * price
+    return values
+
+
+async def fetch_wallet_balance(wallet_type):
+    # Спотовый баланс при работающем user data stream уже есть в памяти
+    if wallet_type == 'spot' and account_state.ready:
+        return wallet_type, account_state.totals()
+    return wallet_type, await balance_cache.get(wallet_type, _fetch_wallet_totals)
+
+
+async def _fetch_wallet_totals(wallet_type):
+    balance = await exchange.fetch_balance({'type': wallet_type})
+    return balance['total']
+
+
+class ValuationEngine:
+    """
+    Оценка активов в котируемой валюте (USDT) по графу конвертаций из load_markets.
+
+    Вершины графа - валюты, ребра - активные спотовые пары. Для каждого актива поиском в ширину от USDT
+    заранее строится кратчайший путь (через USDT напрямую, иначе через BTC, BNB, ETH...), а вся
+    оценка портфеля делается одним fetch_tickers по парам всех путей. Актив без пути или без цены
+    на пути остается без оценки и не роняет остальной расчет.
+    """
+
+    # При равной длине пути предпочитаем самые ликвидные промежуточные валюты
+    HUBS = ('USDT', 'BTC', 'BNB', 'ETH', 'FDUSD', 'USDC')
+
+    def __init__(self, exchange, quote='USDT'):
+        self.exchange = exchange
+        self.quote = quote
+        self._markets = None
+        self._paths = {}
+
+    async def refresh(self):
+        """Перестраивает пути, если ccxt загрузил новый список рынков."""
+        markets = await self.exchange.load_markets()
+        if markets is not self._markets:
+            self._paths = self.build_paths(markets, self.quote, self.HUBS)
+            self._markets = markets
+
+    @staticmethod
+    def build_paths(markets, quote, hubs=()):
+        """
+        :return: {актив: [(пара, инвертировать курс)]} - цепочка пар от актива до quote.
+                 Шаг (пара, False) продает base за quote по last, (пара, True) покупает base за quote.
+        """
+        graph = {}
+        for symbol, market in markets.items():
+            if not market.get('spot') or market.get('active') is False:
+                continue
+            graph.setdefault(market['base'], []).append((market['quote'], symbol, False))
+            graph.setdefault(market['quote'], []).append((market['base'], symbol, True))
+        rank = {hub: i for i, hub in enumerate(hubs)}
+        for edges in graph.values():
+            edges.sort(key=lambda edge: rank.get(edge[0], len(rank)))
+
+        # Поиск в ширину от quote: путь актива = ребро к уже достигнутой валюте + ее путь
+        paths = {quote: []}
+        frontier = [quote]
+        while frontier:
+            next_frontier = []
+            for currency in frontier:
+                for asset, symbol, inverse in graph.get(currency, []):
+                    if asset in paths:
+                        continue
+                    # Ребро currency -> asset с флагом inverse; для пути asset -> currency флаг обратный
+                    paths[asset] = [(symbol, not inverse)] + paths[currency]
+                    next_frontier.append(asset)
+            frontier = next_frontier
+        return paths
+
+    def path(self, asset):
+        return self._paths.get(asset)
+
+    async def prices(self, assets):
+        """Цены активов в quote одним запросом тикеров; активы без оценки в результат не попадают."""
+        await self.refresh()
+        paths = {asset: self._paths[asset] for asset in assets if asset in self._paths}
+        symbols = sorted({symbol for path in paths.values() for symbol, _ in path})
+        tickers = await self.exchange.fetch_tickers(symbols) if symbols else {}
+        prices = {}
+        for asset, path in paths.items():
+            price = 1.0
+            for symbol, inverse in path:
+                last = (tickers.get(symbol) or {}).get('last')
+                if not last:
+                    break
+                price = price / last if inverse else price * last
+            else:
+                prices[asset] = price
+        return prices
+
+
+valuation_engine = ValuationEngine(exchange)
+
+
+def format_wallet_balance(wallet_type, totals, prices):
+    usdt_balance = totals.get('USDT', 0)
+    traded_coins = {coin: amount for coin, amount in totals.items() if coin != 'USDT' and amount > 0}
+    response = [f"\n🔹 Кошелек {wallet_type.capitalize()} 🔹", f"Баланс: {usdt_balance:.2f} USDT"]
+    if traded_coins:
+        for coin, amount in traded_coins.items():
+            if coin not in prices:
+                response.append(f"Торгуется {amount:g} {coin} (нет котировки к USDT)")
+                continue
+            coin_value_usdt = prices[coin] * amount
+            percentage = (coin_value_usdt / (coin_value_usdt + usdt_balance)) * 100
+            response.append(f"Торгуется {coin_value_usdt:.2f} USDT в {coin} ({percentage:.2f}%)")
+    else:
+        response.append("Не торгуется депозитом данного кошелька.")
+    return response
+
+
+class AccountState:
+    """
+    Спотовый аккаунт в памяти: балансы, открытые ордера и последние исполнения.
+
+    Заполняется снимком REST при подключении user data stream и дальше обновляется только его
+    событиями, поэтому чтение не обращается к бирже. ready снят, пока поток не подключен:
+    данные могли устареть, и читатели возвращаются к REST.
+    """
+
+    def __init__(self, resolve_symbol=None, max_fills=500):
+        # Биржевой id пары (BTCUSDT) -> унифицированный символ ccxt (BTC/USDT)
+        self.resolve_symbol = resolve_symbol or (lambda market_id: market_id)
+        self.balances = {}
+        self.open_orders = {}
+        self.fills = deque(maxlen=max_fills)
+        self.ready = False
+        self.updated = None
+
+    def load_snapshot(self, balance, open_orders=(), fills=()):
+        """
+        Снимок в формате ccxt: результат fetch_balance, список ордеров fetch_open_orders и сделки
+        fetch_my_trades.
+
+        Исполнения заменяются сделками снимка: сделки, прошедшие, пока поток был отключен, берутся из них,
+        а не теряются, и дальше история продолжается событиями потока.
+        """
+        self.balances = {asset: {"free": balance['free'].get(asset, 0.0), "used": balance['used'].get(asset, 0.0),
+                                 "total": total or 0.0}
+                         for asset, total in balance['total'].items()}
+        self.open_orders = {}
+        for order in open_orders:
+            self.open_orders[order['id']] = {
+                "id": order['id'], "clientOrderId": order.get('clientOrderId'), "symbol": order['symbol'],
+                "side": order['side'], "type": order['type'], "price": order['price'], "amount": order['amount'],
+                "filled": order['filled'], "status": (order.get('info') or {}).get('status', 'NEW'),
+                "timestamp": order['timestamp'],
+            }
+        self.fills.clear()
+        for trade in sorted(fills, key=lambda trade: trade['timestamp']):
+            self.fills.append({
+                "id": str(trade['id']), "order": trade.get('order'), "symbol": trade['symbol'],
+                "side": trade['side'], "amount": trade['amount'], "price": trade['price'], "cost": trade['cost'],
+                "fee": trade.get('fee'), "timestamp": trade['timestamp'],
+            })
+
+    def totals(self):
+        return {asset: entry['total'] for asset, entry in self.balances.items()}
+
+    def recent_fills(self, symbol=None, limit=5):
+        """Последние исполнения (по возрастанию времени, как fetch_my_trades)."""
+        fills = [fill for fill in reversed(self.fills) if symbol is None or fill['symbol'] == symbol][:limit]
+        return fills[::-1]
+
+    def apply(self, event):
+        """
+        Применяет событие потока и возвращает исполнение (dict), если событие - сделка.
+
+        balanceUpdate не применяется: после любого изменения баланса биржа присылает
+        outboundAccountPosition с итоговыми значениями.
+        """
+        self.updated = event.get('E', self.updated)
+        if event.get('e') == 'outboundAccountPosition':
+            for entry in event['B']:
+                free, locked = float(entry['f']), float(entry['l'])
+                self.balances[entry['a']] = {"free": free, "used": locked, "total": free + locked}
+        elif event.get('e') == 'executionReport':
+            return self._apply_execution_report(event)
+        return None
+
+    def _apply_execution_report(self, event):
+        order_id = str(event['i'])
+        symbol = self.resolve_symbol(event['s'])
+        if event['X'] in ('NEW', 'PARTIALLY_FILLED'):
+            self.open_orders[order_id] = {
+                "id": order_id, "clientOrderId": event['c'], "symbol": symbol, "side": event['S'].lower(),
+                "type": event['o'].lower(), "price": float(event['p']), "amount": float(event['q']),
+                "filled": float(event['z']), "status": event['X'], "timestamp": event['O'],
+            }
+        else:
+            self.open_orders.pop(order_id, None)
+        if event['x'] != 'TRADE':
+            return None
+        # Сделка между подключением и снимком приходит и в снимке, и событием из буфера сокета
+        if any(fill['id'] == str(event['t']) and fill['symbol'] == symbol for fill in self.fills):
+            return None
+        fill = {
+            "id": str(event['t']), "order": order_id, "symbol": symbol, "side": event['S'].lower(),
+            "amount": float(event['l']), "price": float(event['L']), "cost": float(event['Y']),
+            "fee": {"cost": float(event['n']), "currency": event['N']}, "timestamp": event['T'],
+        }
+        self.fills.append(fill)
+        return fill
+
+
+class UserDataStream:
+    """
+    Клиент user data stream Binance: listenKey через REST, события через WebSocket.
+
+    listenKey живет 60 минут и продлевается каждые keepalive секунд. После подключения загружается снимок
+    REST (события, пришедшие во время загрузки, ждут в буфере сокета и применяются поверх него). При обрыве,
+    истечении ключа или ошибке клиент берет новый ключ и переподключается с нарастающей паузой.
+    """
+
+    WS_URL = 'wss://stream.binance.com:9443/ws/'
+
+    def __init__(self, exchange, state, keepalive=30 * 60, on_fill=None, fill_symbols=(), fill_limit=50):
+        self.exchange = exchange
+        self.state = state
+        self.keepalive = keepalive
+        self.on_fill = on_fill
+        # Пары, по которым в снимок загружаются последние fill_limit сделок
+        self.fill_symbols = list(fill_symbols)
+        self.fill_limit = fill_limit
+
+    async def create_listen_key(self):
+        return (await self.exchange.publicPostUserDataStream())['listenKey']
+
+    async def keep_alive(self, listen_key):
+        await self.exchange.publicPutUserDataStream({'listenKey': listen_key})
+
+    async def load_snapshot(self):
+        await self.exchange.load_markets()
+        # Ордера по всем парам одним запросом: вес выше, но запрос делается только при подключении
+        self.exchange.options['warnOnFetchOpenOrdersWithoutSymbol'] = False
+        balance, open_orders, *trades = await asyncio.gather(
+            self.exchange.fetch_balance({'type': 'spot'}), self.exchange.fetch_open_orders(),
+            *(self.exchange.fetch_my_trades(symbol, limit=self.fill_limit) for symbol in self.fill_symbols))
+        self.state.load_snapshot(balance, open_orders, [trade for symbol_trades in trades for trade in symbol_trades])
+
+    @asynccontextmanager
+    async def connect(self, listen_key):
+        """Асинхронный итератор событий (dict) одного подключения."""
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.WS_URL + listen_key, heartbeat=60) as ws:
+                yield self._decode(ws)
+
+    @staticmethod
+    async def _decode(ws):
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                yield json.loads(msg.data)
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                raise ws.exception()
+
+    async def _keep_alive_loop(self, listen_key):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            try:
+                await self.keep_alive(listen_key)
+            except Exception as e:
+                logging.error(f"Ошибка продления listenKey: {e}")
+
+    async def session(self):
+        """Одно подключение: до обрыва или события listenKeyExpired."""
+        listen_key = await self.create_listen_key()
+        keep_alive = asyncio.create_task(self._keep_alive_loop(listen_key))
+        try:
+            async with self.connect(listen_key) as events:
+                await self.load_snapshot()
+                self.state.ready = True
+                async for event in events:
+                    if event.get('e') == 'listenKeyExpired':
+                        return
+                    fill = self.state.apply(event)
+                    if fill is not None and self.on_fill is not None:
+                        self.on_fill(fill)
+        finally:
+            self.state.ready = False
+            keep_alive.cancel()
+
+    async def run(self):
+        delay = 1
+        while True:
+            try:
+                await self.session()
+                delay = 1
+            except Exception as e:
+                logging.error(f"Ошибка user data stream: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+class MockUserDataStream(UserDataStream):
+    """
+    Локальный поток для проверок без биржи: события подаются через push(), снимок задается в конструкторе.
+
+    close() завершает текущее подключение так же, как событие listenKeyExpired.
+    """
+
+    def __init__(self, state, snapshot=None, open_orders=(), fills=(), on_fill=None):
+        super().__init__(None, state, on_fill=on_fill)
+        self.snapshot = snapshot or {'free': {}, 'used': {}, 'total': {}}
+        self.open_orders = list(open_orders)
+        self.fills = list(fills)
+        self.connections = 0
+        self._events = asyncio.Queue()
+
+    def push(self, event):
+        self._events.put_nowait(event)
+
+    def close(self):
+        self.push({'e': 'listenKeyExpired'})
+
+    async def create_listen_key(self):
+        return 'mock'
+
+    async def keep_alive(self, listen_key):
+        pass
+
+    async def load_snapshot(self):
+        self.state.load_snapshot(self.snapshot, self.open_orders, self.fills)
+
+    @asynccontextmanager
+    async def connect(self, listen_key):
+        self.connections += 1
+        yield self._queued_events()
+
+    async def _queued_events(self):
+        while True:
+            yield await self._events.get()
+
+
+account_state = AccountState(exchange.safe_symbol)
+# Сделка меняет балансы, поэтому REST-снимки кошельков сбрасываются
+user_data_stream = UserDataStream(exchange, account_state, on_fill=lambda fill: balance_cache.invalidate(),
+                                  fill_symbols=TRADE_HISTORY_SYMBOLS)
+
+
+class BalanceHistoryStore:
+    """
+    История стоимости портфеля в одном файле, который только дописывается.
+
+    Замеры копятся в памяти и сбрасываются блоками по block_size штук; до этого каждый замер дописывается
+    в журнал (path + '.journal', строка JSON на замер), который при открытии восстанавливается, а после
+    записи блока очищается, так что перезапуск и сбой не теряют историю. Блок - заголовок (время первого и
+    последнего замера, число замеров, колонок и байт данных) и сжатые zlib данные: имена колонок,
+    разности отметок времени и разности стоимостей в центах по каждой колонке. Разности соседних
+    замеров малы и хорошо сжимаются. Заголовки всех блоков держатся в памяти, поэтому чтение диапазона
+    распаковывает только пересекающиеся с ним блоки.
+    """
+
+    HEADER = struct.Struct('<qqIII')
+    SCALE = 100
+
+    def __init__(self, path, block_size=12):
+        self.path = path
+        self.block_size = block_size
+        # (первая отметка, последняя отметка, число замеров, число колонок, смещение данных, длина данных)
+        self.index = []
+        self._pending = []
+        self.journal_path = path + '.journal'
+        self._load_index()
+        self._load_journal()
+
+    def _load_index(self):
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        offset = 0
+        with open(self.path, 'rb') as file:
+            while offset + self.HEADER.size <= size:
+                first, last, count, columns, length = self.HEADER.unpack(file.read(self.HEADER.size))
+                data_offset = offset + self.HEADER.size
+                if data_offset + length > size:
+                    break
+                self.index.append((first, last, count, columns, data_offset, length))
+                file.seek(length, 1)
+                offset = data_offset + length
+        if offset < size:
+            # Недописанный блок после аварийной остановки
+            logging.warning(f"Отброшен поврежденный хвост истории баланса: {size - offset} байт")
+            os.truncate(self.path, offset)
+
+    def _load_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        # Если сбой случился между записью блока и очисткой журнала, замеры уже есть в блоке
+        last = self.index[-1][1] if self.index else None
+        with open(self.journal_path) as file:
+            for line in file:
+                try:
+                    timestamp, values = json.loads(line)
+                except ValueError:
+                    # Недописанная последняя строка
+                    break
+                if last is None or timestamp > last:
+                    self._pending.append((timestamp, values))
+
+    def append(self, timestamp, values):
+        """Добавляет замер: отметка времени в мс и {колонка: стоимость в USDT}."""
+        with open(self.journal_path, 'a') as file:
+            file.write(json.dumps([timestamp, values]) + '\n')
+        self._pending.append((timestamp, values))
+        if len(self._pending) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        columns = sorted({column for _, values in self._pending for column in values})
+        times = np.array([timestamp for timestamp, _ in self._pending], dtype=np.int64)
+        matrix = np.array([[round(values.get(column, 0.0) * self.SCALE) for column in columns]
+                           for _, values in self._pending], dtype=np.int64)
+        payload = zlib.compress('\n'.join(columns).encode() + b'\0'
+                                + np.diff(times, prepend=0).tobytes()
+                                + np.diff(matrix, axis=0, prepend=np.zeros((1, len(columns)), np.int64)).tobytes())
+        header = self.HEADER.pack(int(times[0]), int(times[-1]), len(times), len(columns), len(payload))
+        with open(self.path, 'ab') as file:
+            offset = file.tell() + self.HEADER.size
+            file.write(header + payload)
+        self.index.append((int(times[0]), int(times[-1]), len(times), len(columns), offset, len(payload)))
+        self._pending = []
+        os.truncate(self.journal_path, 0)
+
+    def read(self, start=0, end=None):
+        """Замеры в диапазоне [start, end] (мс) - DataFrame с индексом Time и колонками активов."""
+        end = end if end is not None else 2 ** 62
+        frames = []
+        blocks = [block for block in self.index if block[1] >= start and block[0] <= end]
+        if blocks:
+            with open(self.path, 'rb') as file:
+                for _, _, count, columns, offset, length in blocks:
+                    file.seek(offset)
+                    frames.append(self._decode_block(file.read(length), count, columns))
+        if self._pending:
+            frames.append(pd.DataFrame([values for _, values in self._pending],
+                                       index=[timestamp for timestamp, _ in self._pending]))
+        if not frames:
+            return pd.DataFrame()
+        data = pd.concat(frames).fillna(0.0)
+        data = data[(data.index >= start) & (data.index <= end)]
+        data.index = pd.to_datetime(data.index, unit='ms')
+        data.index.name = 'Time'
+        return data
+
+    def _decode_block(self, payload, count, columns):
+        raw = zlib.decompress(payload)
+        names_end = raw.index(b'\0')
+        names = raw[:names_end].decode().split('\n') if columns else []
+        numbers = np.frombuffer(raw, dtype=np.int64, offset=names_end + 1)
+        times = np.cumsum(numbers[:count])
+        values = np.cumsum(numbers[count:].reshape(count, columns), axis=0) / self.SCALE
+        return pd.DataFrame(values, index=times, columns=names)
+
+
+balance_history = BalanceHistoryStore(os.path.join(DATA_DIR, 'balance_history.bin'))
+
+
+class BalanceHistoryRecorder:
+    """Периодически записывает стоимость портфеля (итог в колонке TOTAL и по активам) в BalanceHistoryStore."""
+
+    def __init__(self, store, interval=300):
+        self.store = store
+        self.interval = interval
+
+    async def record(self):
+        wallets, prices = await fetch_portfolio()
+        values = portfolio_values(wallets, prices)
+        values['TOTAL'] = sum(values.values())
+        self.store.append(exchange.milliseconds(), values)
+
+    async def run(self):
+        while True:
+            try:
+                await self.record()
+            except Exception as e:
+                logging.error(f"Ошибка при записи истории баланса: {e}")
+            await asyncio.sleep(self.interval)
+
+
+@dp.message_handler(commands=['pnl'])
+async def pnl_command(message: types.Message):
+    """/pnl [период] - график стоимости портфеля; период в формате ccxt (24h, 7d, 1M, 1y) или all."""
+    period = message.get_args().strip() or '7d'
+    try:
+        start = 0 if period == 'all' else exchange.milliseconds() - exchange.parse_timeframe(period) * 1000
+    except Exception:
+        await message.answer("Неверный период. Примеры: /pnl 24h, /pnl 7d, /pnl 30d, /pnl all")
+        return
+    history = balance_history.read(start)
+    if len(history) < 2 or 'TOTAL' not in history:
+        await message.answer("Недостаточно истории баланса за этот период.")
+        return
+    totals = history['TOTAL']
+    change = totals.iloc[-1] - totals.iloc[0]
+    percent = change / totals.iloc[0] * 100 if totals.iloc[0] else 0.0
+    try:
+        image = await chart_service.render(render_pnl_chart, totals.index.to_numpy(), totals.to_numpy(),
+                                           f'Portfolio value, {period}')
+        await message.answer_photo(chart_input_file(image, 'pnl.png'),
+                                   caption=f"PnL за {period}: {change:+.2f} USDT ({percent:+.2f}%)\n"
+                                           f"Сейчас: {totals.iloc[-1]:.2f} USDT")
+    except Exception as e:
+        logging.error(f"Ошибка при построении графика PnL: {e}")
+        await message.answer("Ошибка при построении графика PnL.")
+    await show_menu_after_request(message)
+
+
+class FigureGuard:
+    """
+    Учет фигур, созданных через new_figure, в текущем процессе.
+
+    figure_to_bytes освобождает фигуру после сохранения, поэтому все, что осталось открытым после рендера,
+    считается утечкой (например, функция рендера упала до сохранения) и очищается через reclaim().
+    """
+
+    def __init__(self):
+        self._figures = weakref.WeakSet()
+        self.created = 0
+        self.reclaimed = 0
+
+    @property
+    def open_figures(self):
+        return len(self._figures)
+
+    def track(self, fig):
+        self._figures.add(fig)
+        self.created += 1
+
+    def release(self, fig):
+        # Очищаем артисты сразу: память освобождается, даже если на фигуру еще осталась ссылка
+        fig.clear()
+        self._figures.discard(fig)
+
+    def reclaim(self):
+        """Очищает все открытые фигуры и возвращает их количество."""
+        leaked = list(self._figures)
+        for fig in leaked:
+            self.release(fig)
+        if leaked:
+            self.reclaimed += len(leaked)
+            # У фигур matplotlib циклические ссылки, без сборщика они живут до следующего цикла GC
+            gc.collect()
+        return len(leaked)
+
+
+figure_guard = FigureGuard()
+
+
+def _guarded_render(render_func, args, kwargs):
+    """Выполняет рендер в рабочем процессе и возвращает (изображение, число утекших фигур)."""
+    try:
+        image = render_func(*args, **kwargs)
+    except Exception as e:
+        # Атрибуты исключения переживают передачу из процесса пула
+        e.leaked_figures = figure_guard.reclaim()
+        raise
+    return image, figure_guard.reclaim()
+
+
+class ChartService:
+    """
+    Пул процессов для рендера графиков.
+
+    Функции рендера строят Figure через объектный API Agg, без глобального состояния pyplot, поэтому
+    параллельные графики не мешают друг другу, а обработчики не блокируют цикл событий.
+    После каждого рендера рабочий процесс очищает незакрытые фигуры; их число копится в leaked_figures.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._executor = None
+        self.renders = 0
+        self.failures = 0
+        self.leaked_figures = 0
+
+    @property
+    def executor(self):
+        # Процессы создаются при первом рендере, а не при импорте модуля
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=WORKER_MP_CONTEXT)
+        return self._executor
+
+    async def render(self, render_func, *args, **kwargs):
+        """Выполняет функцию рендера (верхнего уровня модуля) в пуле и возвращает изображение в байтах."""
+        loop = asyncio.get_running_loop()
+        try:
+            image, leaked = await loop.run_in_executor(self.executor, _guarded_render, render_func, args, kwargs)
+        except Exception as e:
+            self.failures += 1
+            self._record_leaks(render_func, getattr(e, 'leaked_figures', 0))
+            raise
+        self.renders += 1
+        self._record_leaks(render_func, leaked)
+        return image
+
+    def _record_leaks(self, render_func, leaked):
+        if leaked:
+            self.leaked_figures += leaked
+            logging.warning(f"chart_leaked_figures render={render_func.__name__} leaked={leaked} "
+                            f"total={self.leaked_figures}")
+
+    def metrics(self):
+        return {
+            "chart_renders_total": self.renders,
+            "chart_render_failures_total": self.failures,
+            "chart_leaked_figures_total": self.leaked_figures,
+        }
+
+
+chart_service = ChartService(max_workers=int(os.getenv('CHART_WORKERS', 2)))
+
+
+def bot_metrics():
+    """Счетчики бота (растут с момента запуска) для мониторинга и алертов."""
+    return {
+        **chart_service.metrics(),
+        "exchange_requests_total": exchange.requests,
+        "exchange_requests_shared_total": exchange.shared,
+    }
+
+
+def format_metrics(metrics):
+    return " ".join(f"{name}={value}" for name, value in metrics.items())
+
+
+async def log_metrics(interval):
+    """Периодически пишет метрики одной строкой "metrics name=value ...", которую можно разбирать в алертах."""
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"metrics {format_metrics(bot_metrics())}")
+
+
+@dp.message_handler(commands=['metrics'])
+async def metrics_command(message: types.Message):
+    if message.from_user.id != admin_id:
+        return
+    await message.answer("\n".join(f"{name}: {value}" for name, value in bot_metrics().items()))
+
+
+# Пределы количества точек линий и свечей на графике после прореживания
+CHART_MAX_POINTS = 600
+CHART_MAX_CANDLES = 150
+# Сколько свечей загружать для графика
+CHART_CANDLES = int(os.getenv('CHART_CANDLES', 500))
+# Разрешение аналитических графиков MarketAnalysis и уровень сжатия PNG
+REPORT_DPI = 80
+PNG_COMPRESS_LEVEL = 3
+
+
+def new_figure(width=10, height=5, dpi=100):
+    """Создает Figure с холстом Agg, не регистрируя его в pyplot."""
+    fig = Figure(figsize=(width, height), dpi=dpi)
+    FigureCanvasAgg(fig)
+    figure_guard.track(fig)
+    return fig
+
+
+def figure_to_bytes(fig, fmt='png'):
+    buf = io.BytesIO()
+    if fmt == 'png':
+        # Умеренное сжатие: PNG кодируется быстрее, а размер растет незначительно
+        fig.savefig(buf, format=fmt, pil_kwargs={'compress_level': PNG_COMPRESS_LEVEL})
+    else:
+        fig.savefig(buf, format=fmt)
+    figure_guard.release(fig)
+    return buf.getvalue()
+
+
+def chart_input_file(image, filename='chart.png'):
+    """Оборачивает байты изображения для отправки через answer_photo."""
+    return types.InputFile(io.BytesIO(image), filename=filename)
+
+
+def render_price_chart(coin, ohlcv, title, max_points=CHART_MAX_POINTS):
+    """График цены закрытия с аннотацией текущей цены."""
+    times = mdates.date2num(ohlcv[:, 0].astype('datetime64[ms]'))
+    closes = ohlcv[:, 4]
+    keep = lttb(times, closes, max_points)
+
+    fig = new_figure(10, 5)
+    ax = fig.add_subplot()
+    ax.plot(times[keep], closes[keep], label=f'{coin} price')
+    ax.set_title(title)
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Price')
+    ax.xaxis_date()
+    ax.legend()
+    fig.autofmt_xdate()
+
+    # Добавьте аннотацию с текущей ценой на график
+    last_price = closes[-1]
+    ax.annotate(f'Current price: {last_price}', xy=(times[-1], last_price),
+                xytext=(-20, -30), textcoords='offset points',
+                arrowprops=dict(facecolor='black', arrowstyle='->'),
+                horizontalalignment='right')
+    return figure_to_bytes(fig)
+
+
+def render_pnl_chart(times, totals, title, max_points=CHART_MAX_POINTS):
+    """Стоимость портфеля во времени; зеленая, если за период выросла."""
+    times = mdates.date2num(times)
+    keep = lttb(times, totals, max_points)
+    color = 'tab:green' if totals[-1] >= totals[0] else 'tab:red'
+
+    fig = new_figure(10, 5)
+    ax = fig.add_subplot()
+    ax.plot(times[keep], totals[keep], color=color)
+    ax.fill_between(times[keep], totals[keep], totals.min(), color=color, alpha=0.1)
+    ax.axhline(totals[0], color='gray', linestyle='--', linewidth=0.8)
+    ax.set_title(title)
+    ax.set_ylabel('USDT')
+    ax.xaxis_date()
+    fig.autofmt_xdate()
+    return figure_to_bytes(fig)
+
+
+def render_candlestick_chart(coin, ohlcv, title, max_candles=CHART_MAX_CANDLES, max_points=CHART_MAX_POINTS):
+    """
+    Свечной график с объемом, Bollinger Bands, MACD и RSI.
+
+    Индикаторы считаются существующими методами MarketAnalysis по всей истории, а перед рисованием
+    линии прореживаются алгоритмом LTTB, а свечи объединяются в не более чем max_candles свечей.
+    Поэтому время рендера и размер PNG почти не зависят от количества запрошенных свечей.
+    """
+    analyzer = MarketAnalysis(None, None)
+    closes = pd.Series(ohlcv[:, 4])
+    upper, sma, lower = analyzer.compute_bollinger_bands(closes)
+    macd_line, signal_line, histogram = analyzer.compute_macd_series(closes)
+    rsi = analyzer.compute_rsi_series(closes)
+    times = mdates.date2num(ohlcv[:, 0].astype('datetime64[ms]'))
+
+    fig = new_figure(10, 8)
+    grid = fig.add_gridspec(4, 1, height_ratios=[4, 1, 1.3, 1.3], hspace=0.08)
+    ax_price = fig.add_subplot(grid[0])
+    ax_volume, ax_macd, ax_rsi = (fig.add_subplot(grid[i], sharex=ax_price) for i in range(1, 4))
+
+    def plot_line(ax, series, **kwargs):
+        values = np.asarray(series, dtype=float)
+        valid = ~np.isnan(values)
+        keep = lttb(times[valid], values[valid], max_points)
+        ax.plot(times[valid][keep], values[valid][keep], linewidth=1, **kwargs)
+
+    candles = downsample_ohlcv(ohlcv, max_candles)
+    candle_times = mdates.date2num(candles[:, 0].astype('datetime64[ms]'))
+    width = np.median(np.diff(candle_times)) * 0.7 if len(candle_times) > 1 else 0.5
+    colors = np.where(candles[:, 4] >= candles[:, 1], 'tab:green', 'tab:red')
+    ax_price.vlines(candle_times, candles[:, 3], candles[:, 2], colors=colors, linewidth=0.8)
+    ax_price.bar(candle_times, np.abs(candles[:, 4] - candles[:, 1]), width,
+                 bottom=np.minimum(candles[:, 1], candles[:, 4]), color=colors)
+    plot_line(ax_price, upper, color='tab:blue', linestyle='--', label='Bollinger')
+    plot_line(ax_price, sma, color='tab:blue', alpha=0.6)
+    plot_line(ax_price, lower, color='tab:blue', linestyle='--')
+    ax_price.set_title(title)
+    ax_price.legend(loc='upper left')
+
+    ax_volume.bar(candle_times, candles[:, 5], width, color=colors, alpha=0.6)
+    ax_volume.set_ylabel('Vol')
+
+    plot_line(ax_macd, macd_line, color='tab:blue', label='MACD')
+    plot_line(ax_macd, signal_line, color='tab:orange', label='Signal')
+    plot_line(ax_macd, histogram, color='tab:gray', alpha=0.6)
+    ax_macd.axhline(0, color='black', linewidth=0.5)
+    ax_macd.legend(loc='upper left')
+
+    plot_line(ax_rsi, rsi, color='tab:purple', label='RSI')
+    ax_rsi.axhline(30, color='green', linestyle='--', linewidth=0.8)
+    ax_rsi.axhline(70, color='red', linestyle='--', linewidth=0.8)
+    ax_rsi.set_ylim(0, 100)
+    ax_rsi.legend(loc='upper left')
+
+    for ax in (ax_price, ax_volume, ax_macd):
+        ax.tick_params(labelbottom=False)
+    ax_rsi.xaxis_date()
+    fig.autofmt_xdate()
+    return figure_to_bytes(fig)
+
+
+def render_bollinger_bands(closes, upper_band, sma, lower_band, window, num_std, fmt='png'):
+    fig = new_figure(9, 4.5, REPORT_DPI)
+    ax = fig.add_subplot()
+    ax.plot(closes.index, closes.to_numpy(), label='Close Price')
+    ax.plot(upper_band.index, upper_band.to_numpy(), label=f'Upper Band ({num_std} STD)', linestyle='--')
+    ax.plot(lower_band.index, lower_band.to_numpy(), label=f'Lower Band ({num_std} STD)', linestyle='--')
+    ax.plot(sma.index, sma.to_numpy(), label=f'SMA-{window}')
+    ax.set_title('Bollinger Bands')
+    ax.legend()
+    return figure_to_bytes(fig, fmt)
+
+
+def render_stochastic_oscillator(k_percent, d_percent, fmt='png'):
+    fig = new_figure(9, 4.5, REPORT_DPI)
+    ax = fig.add_subplot()
+    ax.plot(k_percent.index, k_percent.to_numpy(), label='%K line')
+    ax.plot(d_percent.index, d_percent.to_numpy(), label='%D line', linestyle='--')
+    ax.set_title('Stochastic Oscillator')
+    ax.legend()
+    return figure_to_bytes(fig, fmt)
+
+
+def render_combined_strategy(closes, upper, lower, buy_signal, sell_signal, macd, signal, rsi, rsi_thresholds,
+                             fmt='png'):
+    fig = new_figure(9, 6.5, REPORT_DPI)
+    ax = fig.subplots(3, 1, sharex=True)
+    ax[0].plot(closes.index, closes.to_numpy(), label='Close Price')
+    ax[0].plot(upper.index, upper.to_numpy(), label='Upper Bollinger Band', linestyle='--')
+    ax[0].plot(lower.index, lower.to_numpy(), label='Lower Bollinger Band', linestyle='--')
+    ax[0].scatter(closes.index[buy_signal], closes[buy_signal], color='green', label='Buy Signal', marker='^')
+    ax[0].scatter(closes.index[sell_signal], closes[sell_signal], color='red', label='Sell Signal', marker='v')
+    ax[0].legend()
+
+    ax[1].plot(macd.index, macd.to_numpy(), label='MACD')
+    ax[1].plot(signal.index, signal.to_numpy(), label='Signal Line')
+    ax[1].legend()
+
+    ax[2].plot(rsi.index, rsi.to_numpy(), label='RSI')
+    ax[2].axhline(y=rsi_thresholds[0], color='green', linestyle='--')
+    ax[2].axhline(y=rsi_thresholds[1], color='red', linestyle='--')
+    ax[2].legend()
+    return figure_to_bytes(fig, fmt)
+
+
+def render_visual_report(data, indicators, fmt='png'):
+    fig = new_figure(9, 4.5, REPORT_DPI)
+    ax = fig.add_subplot()
+    ax.plot(data.index, data['Close'].to_numpy(), label='Close Price')
+    for indicator in indicators:
+        if indicator in data.columns:
+            ax.plot(data.index, data[indicator].to_numpy(), label=indicator)
+    ax.legend()
+    ax.set_title('Market Analysis Report')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Price')
+    return figure_to_bytes(fig, fmt)
+
+
+def render_dashboard(panels, columns=4):
+    """
+    Сетка спарклайнов (small multiples) в одной фигуре.
+
+    :param panels: Список (монета, цены закрытия, последняя цена, изменение за 24 часа в %).
+    """
+    rows = max(1, -(-len(panels) // columns))
+    fig = new_figure(columns * 2.5, rows * 1.4)
+    for i, (coin, closes, last_price, change) in enumerate(panels):
+        ax = fig.add_subplot(rows, columns, i + 1)
+        color = 'tab:green' if change >= 0 else 'tab:red'
+        ax.plot(closes, color=color, linewidth=1.2)
+        ax.fill_between(range(len(closes)), closes, min(closes), color=color, alpha=0.1)
+        ax.set_title(f'{coin}  {last_price:g}  {change:+.2f}%', fontsize=9, color=color)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        for spine in ax.spines.values():
+            spine.set_visible(False)
+    fig.tight_layout()
+    return figure_to_bytes(fig)
+
+
+def lttb(x, y, threshold):
+    """
+    Индексы точек, которые оставляет алгоритм Largest-Triangle-Three-Buckets.
+
+    Ряд делится на threshold - 2 корзины, из каждой берется точка, образующая наибольший треугольник
+    с выбранной точкой предыдущей корзины и средней точкой следующей. Первая и последняя точки сохраняются.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    indices = np.empty(threshold, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    selected = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        areas = np.abs((x[selected] - average_x) * (y[start:end] - y[selected])
+                       - (x[selected] - x[start:end]) * (average_y - y[selected]))
+        selected = start + int(areas.argmax())
+        indices[i + 1] = selected
+    return indices
+
+
+def downsample_ohlcv(ohlcv, max_candles):
+    """Объединяет соседние свечи так, чтобы их осталось не больше max_candles (с сохранением OHLC и объема)."""
+    n = len(ohlcv)
+    if n <= max_candles:
+        return ohlcv
+    starts = np.linspace(0, n, max_candles + 1).astype(int)[:-1]
+    ends = np.r_[starts[1:], n]
+    return np.column_stack([
+        ohlcv[starts, 0],
+        ohlcv[starts, 1],
+        np.maximum.reduceat(ohlcv[:, 2], starts),
+        np.minimum.reduceat(ohlcv[:, 3], starts),
+        ohlcv[ends - 1, 4],
+        np.add.reduceat(ohlcv[:, 5], starts),
+    ])
+
+
+def render_equity_chart(equity, title):
+    """Кривая капитала бэктеста."""
+    fig = new_figure(8, 4)
+    ax = fig.add_subplot()
+    ax.plot(equity.index, equity.to_numpy(), label='Equity')
+    ax.set_title(f'Equity: {title}')
+    ax.legend()
+    fig.autofmt_xdate()
+    return figure_to_bytes(fig)
+
+
+def benchmark_charts(iterations=20, candles=CHART_CANDLES, memory_iterations=3):
+    """
+    Замеряет рендер каждого типа графика в текущем процессе на синтетических свечах.
+
+    Время и память меряются в разных циклах: tracemalloc замедляет аллокации в несколько раз,
+    поэтому в цикле замера времени он выключен.
+
+    :param memory_iterations: Сколько рендеров выполнить под tracemalloc для замера памяти.
+    :return: Словарь {тип графика: {renders_per_sec, ms_per_render, kb_per_render, open_figures}}, где
+             kb_per_render - пик памяти Python-аллокаций за один рендер (tracemalloc).
+    """
+    rng = np.random.default_rng(0)
+    start = time.time() * 1000 - candles * 3600000
+    closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, candles)))
+    ohlcv = [[start + i * 3600000, c, c * 1.01, c * 0.99, c, float(v)]
+             for i, (c, v) in enumerate(zip(closes, rng.uniform(1, 100, candles)))]
+    data = ohlcv_to_dataframe(ohlcv)
+    close = data['Close']
+    analysis = MarketAnalysis.__new__(MarketAnalysis)
+    upper, sma, lower = analysis.compute_bollinger_bands(close)
+    macd, signal, rsi, upper_cc, lower_cc, buy, sell = analysis._combined_indicators(data, 20, (30, 70), 0)
+    k_percent, d_percent = analysis.compute_stochastic_oscillator(data)
+    cases = {
+        'price': (render_price_chart, ('BTC', np.asarray(ohlcv), 'BTC/USDT')),
+        'candles': (render_candlestick_chart, ('BTC', np.asarray(ohlcv), 'BTC/USDT')),
+        'dashboard': (render_dashboard, ([(f'C{i}', list(closes[-24:]), closes[-1], 1.0) for i in range(20)],)),
+        'equity': (render_equity_chart, (close, 'BTC/USDT 1h')),
+        'bollinger': (render_bollinger_bands, (close, upper, sma, lower, 20, 2)),
+        'stochastic': (render_stochastic_oscillator, (k_percent, d_percent)),
+        'combined': (render_combined_strategy, (close, upper_cc, lower_cc, buy, sell, macd, signal, rsi, (30, 70))),
+        'report': (render_visual_report, (data, ['SMA', 'EMA'])),
+    }
+    results = {}
+    for name, (render_func, args) in cases.items():
+        # Первый рендер прогревает кэши шрифтов и не попадает в замер
+        render_func(*args)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            render_func(*args)
+        elapsed = time.perf_counter() - started
+        peak = 0
+        for _ in range(memory_iterations):
+            tracemalloc.start()
+            try:
+                render_func(*args)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        results[name] = {
+            "renders_per_sec": iterations / elapsed,
+            "ms_per_render": elapsed / iterations * 1000,
+            "kb_per_render": peak / 1024,
+            "open_figures": figure_guard.open_figures,
+        }
+    return results
+
+
+class ChartCache:
+    """
+    LRU-кеш готовых графиков, ограниченный суммарным размером изображений в байтах.
+
+    Ключ - (пара, интервал, время открытия последней свечи, стиль графика). Вместе с изображением
+    хранится file_id, который Telegram вернул после первой отправки: повторный запрос пересылает
+    уже загруженное фото без рендера и без повторной загрузки. Последняя свеча еще формируется,
+    поэтому запись живет не дольше ttl секунд.
+    """
+
+    def __init__(self, max_bytes=20 * 1024 * 1024, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry['created'] > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, image, caption, file_id=None):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = {"image": image, "caption": caption, "file_id": file_id, "created": time.monotonic()}
+        self.size += len(image)
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key)['image'])
+
+
+chart_cache = ChartCache(max_bytes=int(os.getenv('CHART_CACHE_BYTES', 20 * 1024 * 1024)),
+                         ttl=int(os.getenv('CHART_CACHE_TTL', 60)))
+
+
+def current_candle_open(timeframe, now=None):
+    """Время открытия (в мс) текущей свечи таймфрейма - ключ кеша графиков без запроса к бирже."""
+    now = exchange.milliseconds() if now is None else now
+    timeframe_ms = exchange.parse_timeframe(timeframe) * 1000
+    # Недельные свечи Binance открываются в понедельник, а 1 января 1970 года - четверг
+    offset = 4 * 24 * 3600 * 1000 if timeframe.endswith('w') else 0
+    return now - (now - offset) % timeframe_ms
+
+
+async def send_cached_chart(message: types.Message, key, produce):
+    """
+    Отправляет график из chart_cache, а при промахе строит его через produce и сохраняет.
+
+    :param key: Ключ ChartCache.
+    :param produce: Корутина-функция без аргументов, возвращающая (изображение, подпись).
+    """
+    entry = chart_cache.get(key)
+    if entry is not None and entry['file_id'] is not None:
+        try:
+            await message.answer_photo(entry['file_id'], caption=entry['caption'])
+            return
+        except Exception as e:
+            logging.warning(f"Не удалось переслать график по file_id, загружаем заново: {e}")
+    if entry is None:
+        image, caption = await produce()
+    else:
+        image, caption = entry['image'], entry['caption']
+    sent = await message.answer_photo(chart_input_file(image), caption=caption)
+    chart_cache.put(key, image, caption, sent.photo[-1].file_id if sent.photo else None)
+
+
+# Интервалы графиков: таймфрейм -> подпись кнопки. Новый интервал достаточно добавить сюда
+CHART_INTERVALS = {
+    '5m': "5 минут",
+    '15m': "15 минут",
+    '1h': "1 час",
+    '4h': "4 часа",
+    '1d': "1 день",
+    '1w': "1 неделя",
+}
+DEFAULT_CHART_INTERVAL = '1d'
+
+
+class ChartPipeline:
+    """
+    Конвейер графика цены: источник данных -> преобразование -> рендер -> отправка.
+
+    Все обработчики, которые показывают график монеты, проходят через него, поэтому кеш, пул рендера
+    и формат данных настраиваются в одном месте.
+    """
+
+    def __init__(self, exchange, renderer, cache, intervals, styles):
+        self.exchange = exchange
+        self.renderer = renderer
+        self.cache = cache
+        self.intervals = intervals
+        self.styles = styles
+        # Ряды кнопок выбора интервала по монетам
+        self._interval_rows = {}
+
+    async def fetch(self, symbol, interval, candles=CHART_CANDLES):
+        """Источник данных: свечи с биржи (больше 1000 свечей загружаются частями)."""
+        if candles > 1000:
+            ohlcv = await fetch_ohlcv_history(symbol, interval, candles)
+        else:
+            ohlcv = await self.exchange.fetch_ohlcv(symbol, interval, limit=candles)
+        logging.info(f"Получены данные для графика {symbol} с интервалом {interval}.")
+        return ohlcv
+
+    def transform(self, ohlcv):
+        """Преобразование: свечи ccxt -> массив (n, 6), который дешево передается в процесс рендера."""
+        return np.asarray(ohlcv, dtype=float)
+
+    async def render(self, coin, interval, ohlcv, style):
+        """Рендер в пуле процессов; возвращает изображение и подпись."""
+        last_price = ohlcv[-1, 4]
+        image = await self.renderer.render(self.styles[style], coin, ohlcv, f'{coin}/USDT, {interval}')
+        return image, f'Price chart for {coin} ({interval}). Current price: {last_price} USDT'
+
+    async def send(self, message: types.Message, coin, interval, style='candles'):
+        """Отправка: из кеша по file_id или после прохождения всех стадий."""
+        if interval not in self.intervals:
+            raise ValueError(f"Неподдерживаемый интервал графика: {interval}")
+        symbol = f'{coin}/USDT'
+
+        async def produce():
+            ohlcv = self.transform(await self.fetch(symbol, interval))
+            return await self.render(coin, interval, ohlcv, style)
+
+        await send_cached_chart(message, (symbol, interval, current_candle_open(interval), style), produce)
+
+    def interval_keyboard(self, coin):
+        """
+        Клавиатура выбора интервала. Кнопки строятся один раз для монеты, а разметка каждый раз новая,
+        чтобы изменения в одном сообщении не попадали в другие.
+        """
+        rows = self._interval_rows.get(coin)
+        if rows is None:
+            markup = InlineKeyboardMarkup(row_width=3)
+            markup.add(InlineKeyboardButton("Показать график", callback_data=f"chart_{coin}"))
+            markup.add(*(InlineKeyboardButton(label, callback_data=f"interval_{interval}_{coin}")
+                         for interval, label in self.intervals.items()))
+            rows = self._interval_rows[coin] = markup.inline_keyboard
+        return InlineKeyboardMarkup(row_width=3, inline_keyboard=[list(row) for row in rows])
+
+
+chart_pipeline = ChartPipeline(exchange, chart_service, chart_cache, CHART_INTERVALS,
+                               {'line': render_price_chart, 'candles': render_candlestick_chart})
+
+
 class PriceQuery(StatesGroup):
     input_coin = State()
 
-async def get_listed_coins():
-    # Здесь можно использовать API, например, CoinMarketCap или Binance, чтобы получить список монет.
-    # Для простоты я буду использовать фиктивный список.
-    return ["BTC", "ETH", "BNB", "ADA", "DOGE", "XRP", "DOT", "UNI", "BCH", "LTC", "LINK", "MATIC", "XLM", "ETC", "THETA", "VET", "TRX", "FIL", "XMR", "EOS"]
+# Список на случай, если каталог еще ни разу не удалось загрузить
+DEFAULT_LISTED_COINS = ["BTC", "ETH", "BNB", "ADA", "DOGE", "XRP", "DOT", "UNI", "BCH", "LTC", "LINK", "MATIC", "XLM",
+                        "ETC", "THETA", "VET", "TRX", "FIL", "XMR", "EOS"]
+
+
+class SymbolIndex:
+    """
+    Поиск монеты по тикеру или названию для ручного ввода.
+
+    Точное совпадение - словарь, префиксный поиск - бинарный поиск по отсортированному списку ключей,
+    нечеткий - индекс триграмм (ключ дополняется краевыми символами, поэтому короткие тикеры тоже
+    дают триграммы) с оценкой по коэффициенту Дайса. При равной оценке выше стоит монета с большим объемом.
+    """
+
+    def __init__(self, coins, names=None):
+        """:param coins: Монеты по убыванию объема; names - {монета: название}."""
+        names = names or {}
+        self.rank = {coin: i for i, coin in enumerate(coins)}
+        self.exact = {}
+        for coin in coins:
+            self.exact[coin] = coin
+            name = (names.get(coin) or '').upper()
+            if name:
+                self.exact.setdefault(name, coin)
+        self.keys = sorted(self.exact)
+        self.trigrams = {}
+        # Число различных триграмм ключа - знаменатель коэффициента Дайса
+        self.trigram_counts = {}
+        for key in self.keys:
+            key_trigrams = self._trigrams(key)
+            self.trigram_counts[key] = len(key_trigrams)
+            for trigram in key_trigrams:
+                self.trigrams.setdefault(trigram, set()).add(key)
+
+    @staticmethod
+    def _trigrams(text):
+        padded = f'^{text}$'
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def lookup(self, query):
+        """Монета по точному тикеру или названию, иначе None."""
+        return self.exact.get(query.strip().upper())
+
+    def prefix(self, query, limit=5):
+        query = query.strip().upper()
+        coins = set()
+        for i in range(bisect.bisect_left(self.keys, query), len(self.keys)):
+            if not self.keys[i].startswith(query):
+                break
+            coins.add(self.exact[self.keys[i]])
+        return sorted(coins, key=self.rank.get)[:limit]
+
+    def fuzzy(self, query, limit=5, min_score=0.3):
+        query_trigrams = self._trigrams(query.strip().upper())
+        shared = {}
+        for trigram in query_trigrams:
+            for key in self.trigrams.get(trigram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        scores = {}
+        for key, count in shared.items():
+            score = 2 * count / (len(query_trigrams) + self.trigram_counts[key])
+            coin = self.exact[key]
+            if score >= min_score and score > scores.get(coin, 0):
+                scores[coin] = score
+        return sorted(scores, key=lambda coin: (-scores[coin], self.rank[coin]))[:limit]
+
+    def suggest(self, query, limit=5):
+        """Варианты для "возможно, вы имели в виду": сначала по префиксу, затем нечеткие."""
+        suggestions = self.prefix(query, limit)
+        for coin in self.fuzzy(query, limit):
+            if len(suggestions) >= limit:
+                break
+            if coin not in suggestions:
+                suggestions.append(coin)
+        return suggestions
+
+
+def suggestion_keyboard(coins, callback_prefix):
+    markup = InlineKeyboardMarkup(row_width=5)
+    markup.add(*(InlineKeyboardButton(coin, callback_data=f"{callback_prefix}{coin}") for coin in coins))
+    return markup
+
+
+class MarketCatalogue:
+    """
+    Каталог монет, торгуемых к USDT на споте, с 24-часовым объемом в USDT.
+
+    Строится из load_markets и одного fetch_tickers, сохраняется на диск в JSON: при старте каталог
+    читается из файла, не дожидаясь сети, а run() обновляет его в фоне. Монеты хранятся уже
+    отсортированными по объему, поэтому выборка топа - это срез.
+    """
+
+    def __init__(self, exchange, path, quote='USDT', refresh_interval=3600):
+        self.exchange = exchange
+        self.path = path
+        self.quote = quote
+        self.refresh_interval = refresh_interval
+        # [(монета, объем)] по убыванию объема, множество монет для проверки наличия и названия монет
+        self.ranked = []
+        self.coins = set()
+        self.names = {}
+        self.index = SymbolIndex([])
+        self.updated = 0
+        self.listeners = []
+        self._load()
+
+    def __contains__(self, coin):
+        return coin in self.coins
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logging.error(f"Поврежден снимок каталога рынков {self.path}: {e}")
+            return
+        self._set(snapshot['coins'], snapshot.get('names', {}), snapshot['updated'])
+
+    def _set(self, ranked, names, updated):
+        self.ranked = [tuple(entry) for entry in ranked]
+        self.coins = {coin for coin, _ in self.ranked}
+        self.names = names
+        self.index = SymbolIndex([coin for coin, _ in self.ranked], names)
+        self.updated = updated
+        for listener in self.listeners:
+            listener(self)
+
+    def subscribe(self, listener):
+        """listener(catalogue) вызывается сразу и после каждого обновления каталога."""
+        self.listeners.append(listener)
+        listener(self)
+
+    async def refresh(self):
+        markets = await self.exchange.load_markets(reload=True)
+        symbols = [symbol for symbol, market in markets.items()
+                   if market.get('spot') and market.get('active') is not False and market['quote'] == self.quote]
+        # Все тикеры без списка символов: для сотен пар вес тот же, а строка запроса не раздувается
+        tickers = await self.exchange.fetch_tickers()
+        volumes = {markets[symbol]['base']: (tickers.get(symbol) or {}).get('quoteVolume') or 0.0 for symbol in symbols}
+        # Полные названия есть, только если ccxt загрузил валюты (fetch_currencies с ключами API)
+        currencies = self.exchange.currencies or {}
+        names = {coin: currencies[coin]['name'] for coin in volumes if (currencies.get(coin) or {}).get('name')}
+        self._set(sorted(volumes.items(), key=lambda item: item[1], reverse=True), names, time.time())
+        # Запись через временный файл, чтобы при сбое не остался обрезанный снимок
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path) or '.', delete=False) as file:
+            json.dump({"updated": self.updated, "coins": self.ranked, "names": self.names}, file)
+        os.replace(file.name, self.path)
+
+    async def ensure_loaded(self):
+        if not self.ranked:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Ошибка при загрузке каталога рынков: {e}")
+                self._set([(coin, 0.0) for coin in DEFAULT_LISTED_COINS], {}, 0)
+
+    def top(self, limit=None, min_volume=0):
+        """Монеты по убыванию объема: не больше limit и с объемом не ниже min_volume (USDT за 24 часа)."""
+        coins = []
+        for coin, volume in self.ranked[:limit]:
+            if volume < min_volume:
+                break
+            coins.append(coin)
+        return coins
+
+    async def run(self):
+        while True:
+            delay = self.refresh_interval - (time.time() - self.updated)
+            if delay <= 0:
+                try:
+                    await self.refresh()
+                    delay = self.refresh_interval
+                except Exception as e:
+                    logging.error(f"Ошибка при обновлении каталога рынков: {e}")
+                    delay = 60
+            await asyncio.sleep(delay)
+
+
+market_catalogue = MarketCatalogue(exchange, os.path.join(DATA_DIR, 'markets.json'),
+                                   refresh_interval=MARKETS_REFRESH_INTERVAL)
+
+
+class CoinKeyboardRegistry:
+    """
+    Готовые клавиатуры выбора монеты: все монеты каталога постранично, по объему или по алфавиту.
+
+    Страницы строятся один раз при обновлении каталога, а нажатия coins_page_{sort}_{page} только
+    берут готовую клавиатуру.
+    """
+
+    SORTS = {'volume': "По объему", 'alpha': "По алфавиту"}
+
+    def __init__(self, page_size=24, columns=4):
+        self.page_size = page_size
+        self.columns = columns
+        self.pages = {sort: [self._build_page(sort, [], 0, 1)] for sort in self.SORTS}
+
+    def build(self, catalogue):
+        coins = catalogue.top()
+        for sort, ordered in (('volume', coins), ('alpha', sorted(coins))):
+            chunks = [ordered[i:i + self.page_size] for i in range(0, len(ordered), self.page_size)] or [[]]
+            self.pages[sort] = [self._build_page(sort, chunk, page, len(chunks)) for page, chunk in enumerate(chunks)]
+
+    def _build_page(self, sort, coins, page, total_pages):
+        markup = InlineKeyboardMarkup(row_width=self.columns)
+        markup.add(*(InlineKeyboardButton(coin, callback_data=f"price_{coin}") for coin in coins))
+        if total_pages > 1:
+            markup.row(
+                InlineKeyboardButton("◀", callback_data=f"coins_page_{sort}_{(page - 1) % total_pages}"),
+                InlineKeyboardButton(f"{page + 1}/{total_pages}", callback_data=f"coins_page_{sort}_{page}"),
+                InlineKeyboardButton("▶", callback_data=f"coins_page_{sort}_{(page + 1) % total_pages}"),
+            )
+        markup.row(*(InlineKeyboardButton(title, callback_data=f"coins_page_{other}_0")
+                     for other, title in self.SORTS.items() if other != sort))
+        markup.add(InlineKeyboardButton("Ввести вручную", callback_data="input_manually"))
+        return markup
+
+    def page(self, sort='volume', page=0):
+        pages = self.pages.get(sort, self.pages['volume'])
+        return pages[min(max(page, 0), len(pages) - 1)]
+
+
+coin_keyboards = CoinKeyboardRegistry()
+market_catalogue.subscribe(coin_keyboards.build)
+
+
+async def get_listed_coins(limit=LISTED_COINS_LIMIT, min_volume=0):
+    """Монеты с парой к USDT по убыванию 24-часового объема; limit=None - весь каталог."""
+    await market_catalogue.ensure_loaded()
+    return market_catalogue.top(limit, min_volume)
 
 @dp.callback_query_handler(lambda c: c.data == 'menu_price')
 async def menu_price_handler(callback_query: types.CallbackQuery):
     logging.info("Обработчик menu_price_handler вызван.")
-    coins = await get_listed_coins()
-    markup = InlineKeyboardMarkup(row_width=4)
-    for coin in coins:
-        button = InlineKeyboardButton(coin, callback_data=f"price_{coin}")
-        markup.add(button)
-    markup.add(InlineKeyboardButton("Ввести вручную", callback_data="input_manually"))
-    await callback_query.message.answer("Выберите монету или введите её вручную:", reply_markup=markup)
+    await market_catalogue.ensure_loaded()
+    await callback_query.message.answer("Выберите монету или введите её вручную:", reply_markup=coin_keyboards.page())
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith('coins_page_'))
+async def coins_page_handler(callback_query: types.CallbackQuery):
+    sort, page = callback_query.data[len('coins_page_'):].rsplit('_', 1)
+    try:
+        await callback_query.message.edit_reply_markup(coin_keyboards.page(sort, int(page)))
+    except MessageNotModified:
+        pass
     await callback_query.answer()
 
 
@@ -722,40 +3112,123 @@ async def ask_for_coin(callback_query: types.CallbackQuery):
 @dp.message_handler(state=PriceQuery.input_coin)
 async def get_price_for_input(message: types.Message, state: FSMContext):
     logging.info("Обработчик get_price_for_input вызван.")
-    coin = message.text.upper()
-    coins = await get_listed_coins()  # Получаем список доступных монет
-    if coin not in coins:
-        await message.answer(f"Монета {coin} не найдена. Пожалуйста, введите другую монету.")
+    await market_catalogue.ensure_loaded()
+    coin = market_catalogue.index.lookup(message.text)
+    queries = split_coin_queries(message.text)
+    if coin is None and len(queries) > 1:
+        await state.finish()
+        await send_price_table(message, queries)
+        return
+    if coin is None:
+        query = message.text.strip().upper()
+        suggestions = market_catalogue.index.suggest(query)
+        if suggestions:
+            await message.answer(f"Монета {query} не найдена. Возможно, вы имели в виду:",
+                                 reply_markup=suggestion_keyboard(suggestions, 'suggest_price_'))
+        else:
+            await message.answer(f"Монета {query} не найдена. Пожалуйста, введите другую монету.")
         return
+    await state.finish()
+    await send_coin_price(message, coin)
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith('suggest_price_'), state='*')
+async def suggested_coin_price(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.finish()
+    await send_coin_price(callback_query.message, callback_query.data[len('suggest_price_'):])
+    await callback_query.answer()
+
+
+# Сколько монет можно запросить одной таблицей
+PRICE_TABLE_LIMIT = 30
+
+
+@dp.message_handler(commands=['price'])
+async def price_command(message: types.Message):
+    """/price BTC,ETH,SOL - таблица цен; без аргументов - BTC."""
+    await market_catalogue.ensure_loaded()
+    await send_price_table(message, split_coin_queries(message.get_args()) or ['BTC'])
+
+
+def split_coin_queries(text):
+    # Пробел не разделитель: названия монет бывают из нескольких слов ("Bitcoin Cash")
+    return [query.strip() for query in re.split(r'[,;]', text.upper()) if query.strip()]
+
+
+def format_quote_price(price):
+    if price is None:
+        return '-'
+    return f"{price:,.2f}" if price >= 1 else f"{price:.8f}".rstrip('0').rstrip('.')
+
+
+def format_quote_volume(volume):
+    if volume is None:
+        return '-'
+    for divisor, suffix in ((1e9, 'B'), (1e6, 'M'), (1e3, 'K')):
+        if volume >= divisor:
+            return f"{volume / divisor:.2f}{suffix}"
+    return f"{volume:.0f}"
+
+
+async def send_price_table(message: types.Message, queries):
+    """Последняя цена, изменение за 24 часа и объем в USDT для нескольких монет одним запросом тикеров."""
+    coins, unknown = [], []
+    for query in queries[:PRICE_TABLE_LIMIT]:
+        coin = market_catalogue.index.lookup(query)
+        if coin is None:
+            unknown.append(query)
+        elif coin not in coins:
+            coins.append(coin)
+    lines = []
+    if coins:
+        try:
+            tickers = await exchange.fetch_tickers([f'{coin}/USDT' for coin in coins])
+        except Exception as e:
+            logging.error(f"Ошибка при получении цен {coins}: {e}")
+            await message.answer("Ошибка при получении цен. Пожалуйста, попробуйте позже.")
+            return
+        rows = [("Coin", "Last", "24h %", "Volume")]
+        for coin in coins:
+            ticker = tickers.get(f'{coin}/USDT') or {}
+            change = ticker.get('percentage')
+            rows.append((coin, format_quote_price(ticker.get('last')),
+                         f"{change:+.2f}%" if change is not None else '-',
+                         format_quote_volume(ticker.get('quoteVolume'))))
+        widths = [max(len(row[i]) for row in rows) for i in range(4)]
+        table = "\n".join(row[0].ljust(widths[0]) + "  " + "  ".join(cell.rjust(width) for cell, width in
+                                                                       zip(row[1:], widths[1:])) for row in rows)
+        lines.append(f"<pre>{html.escape(table)}</pre>")
+    if unknown:
+        hints = []
+        for query in unknown:
+            suggestions = market_catalogue.index.suggest(query, limit=3)
+            hints.append(f"{query} (возможно: {', '.join(suggestions)})" if suggestions else query)
+        lines.append(html.escape("Не найдены: " + "; ".join(hints)))
+    if len(queries) > PRICE_TABLE_LIMIT:
+        lines.append(f"Показаны первые {PRICE_TABLE_LIMIT} монет.")
+    await message.answer("\n".join(lines), parse_mode='HTML')
+
+
+async def send_coin_price(message: types.Message, coin):
     try:
         ticker = await exchange.fetch_ticker(f'{coin}/USDT')
         await message.answer(f"Текущая цена {coin} равна {ticker['last']} USDT")
 
         # Предоставляем пользователю возможность выбрать временной интервал для графика
-        markup = InlineKeyboardMarkup()
-        markup.add(InlineKeyboardButton("Показать график", callback_data=f"chart_{coin}"))
-        markup.add(InlineKeyboardButton("1 час", callback_data=f"interval_1h_{coin}"))
-        markup.add(InlineKeyboardButton("1 день", callback_data=f"interval_1d_{coin}"))
-        markup.add(InlineKeyboardButton("1 неделя", callback_data=f"interval_1w_{coin}"))
-        await message.answer("Выберите временной интервал для графика:", reply_markup=markup)
+        await message.answer("Выберите временной интервал для графика:",
+                             reply_markup=chart_pipeline.interval_keyboard(coin))
 
     except Exception as e:
         logging.error(f"Ошибка при получении цены: {e}")
         await message.answer(f"Ошибка при получении цены для {coin}. Пожалуйста, попробуйте позже.")
-    await state.finish()
 
 
 @dp.callback_query_handler(lambda c: c.data.startswith('price_'))
 async def show_coin_price(callback_query: types.CallbackQuery):
     logging.info("Обработчик show_coin_price вызван.")
     coin = callback_query.data.split('_')[1]
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("Показать график", callback_data=f"chart_{coin}"))
-    markup.add(InlineKeyboardButton("1 час", callback_data=f"interval_1h_{coin}"))
-    markup.add(InlineKeyboardButton("1 день", callback_data=f"interval_1d_{coin}"))
-    markup.add(InlineKeyboardButton("1 неделя", callback_data=f"interval_1w_{coin}"))
-    # ... добавьте другие интервалы по желанию ...
-    await callback_query.message.answer("Выберите временной интервал для графика:", reply_markup=markup)
+    await callback_query.message.answer("Выберите временной интервал для графика:",
+                                        reply_markup=chart_pipeline.interval_keyboard(coin))
     await callback_query.answer()
 
 
@@ -763,132 +3236,90 @@ async def show_coin_price(callback_query: types.CallbackQuery):
 async def show_chart(callback_query: types.CallbackQuery):
     logging.info("Обработчик show_chart вызван.")
     interval, coin = callback_query.data.split('_')[1:3]
+    await send_chart_with_menu(callback_query, coin, interval)
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith('chart_'))
+async def handle_chart_request(callback_query: types.CallbackQuery):
+    logging.info("Обработчик handle_chart_request вызван.")
+    coin = callback_query.data.split('_')[1]
+    await send_chart_with_menu(callback_query, coin, DEFAULT_CHART_INTERVAL)
 
-    try:
-        # Получите данные для графика с учетом выбранного интервала
-        ohlc_data = await exchange.fetch_ohlcv(f'{coin}/USDT', interval)
-        logging.info(f"Получены данные для графика {coin} с интервалом {interval}.")
-
-        # Разделите данные на отдельные списки для времени, открытия, максимума, минимума и закрытия
-        times = [x[0] for x in ohlc_data]
-        opens = [x[1] for x in ohlc_data]
-        highs = [x[2] for x in ohlc_data]
-        lows = [x[3] for x in ohlc_data]
-        closes = [x[4] for x in ohlc_data]
-
-        # Постройте график
-        plt.figure(figsize=(10, 5))
-        plt.plot(times, closes, label=f'{coin} price')
-        plt.title(f'Price of {coin} for the last {interval}')
-        plt.xlabel('Time')
-        plt.ylabel('Price')
-        plt.legend()
-
-        # Добавьте аннотацию с текущей ценой на график
-        last_price = closes[-1]
-        plt.annotate(f'Current price: {last_price}', xy=(times[-1], last_price),
-                     xytext=(times[-1] - 0.5, last_price + 0.5),
-                     arrowprops=dict(facecolor='black', arrowstyle='->'),
-                     horizontalalignment='right')
-
-        # Сохраните график в байтовый поток и отправьте его пользователю
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        await callback_query.message.answer_photo(buf,
-                                                  caption=f'Price chart for {coin} ({interval}). Current price: {last_price} USDT')
-        buf.close()
-
-        # Закройте график, чтобы освободить память
-        plt.close()
 
+async def send_chart_with_menu(callback_query: types.CallbackQuery, coin, interval):
+    try:
+        await chart_pipeline.send(callback_query.message, coin, interval)
     except Exception as e:
         logging.error(f"Ошибка при построении графика для {coin} с интервалом {interval}: {e}")
         await callback_query.message.answer(f"Ошибка при построении графика для {coin}. Пожалуйста, попробуйте позже.")
 
     # После отправки графика, покажем пользователю кнопки для выбора временного интервала снова
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("Показать график", callback_data=f"chart_{coin}"))
-    markup.add(InlineKeyboardButton("1 час", callback_data=f"interval_1h_{coin}"))
-    markup.add(InlineKeyboardButton("1 день", callback_data=f"interval_1d_{coin}"))
-    markup.add(InlineKeyboardButton("1 неделя", callback_data=f"interval_1w_{coin}"))
-    # ... добавьте другие интервалы по желанию ...
-
-    await callback_query.message.answer("Выберите временной интервал для графика:", reply_markup=markup)
-    await callback_query.answer()
+    await callback_query.message.answer("Выберите временной интервал для графика:",
+                                        reply_markup=chart_pipeline.interval_keyboard(coin))
     # После отправки графика, отправляем пользователю основное меню
     await callback_query.message.answer("Выберите действие из меню:", reply_markup=menu)
     await callback_query.answer()
 
 
+# Таймфрейм и количество свечей спарклайнов на дашборде (сутки часовых свечей)
+DASHBOARD_TIMEFRAME = '1h'
+DASHBOARD_CANDLES = 24
 
-@dp.callback_query_handler(lambda c: c.data.startswith('chart_'))
-async def handle_chart_request(callback_query: types.CallbackQuery):
-    logging.info("Обработчик handle_chart_request вызван.")
-    coin = callback_query.data.split('_')[1]
 
-    try:
-        # Получите данные для графика с учетом выбранного интервала
-        ohlc_data = await exchange.fetch_ohlcv(f'{coin}/USDT', '1d')  # Пример интервала в 1 день
-        logging.info(f"Получены данные для графика {coin} с интервалом 1d.")
-
-        # Разделите данные на отдельные списки для времени, открытия, максимума, минимума и закрытия
-        times = [x[0] for x in ohlc_data]
-        closes = [x[4] for x in ohlc_data]
-
-        # Постройте график
-        plt.figure(figsize=(10, 5))
-        plt.plot(times, closes, label=f'{coin} price')
-        plt.title(f'Price of {coin} for the last day')
-        plt.xlabel('Time')
-        plt.ylabel('Price')
-        plt.legend()
-
-        # Добавьте аннотацию с текущей ценой на график
-        last_price = closes[-1]
-        plt.annotate(f'Current price: {last_price}', xy=(times[-1], last_price),
-                     xytext=(times[-1] - 0.5, last_price + 0.5),
-                     arrowprops=dict(facecolor='black', arrowstyle='->'),
-                     horizontalalignment='right')
-
-        # Сохраните график в байтовый поток и отправьте его пользователю
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        await callback_query.message.answer_photo(buf,
-                                                  caption=f'Price chart for {coin} (1d). Current price: {last_price} USDT')
-        buf.close()
-
-        # Закройте график, чтобы освободить память
-        plt.close()
+@dp.message_handler(commands=['dashboard'])
+async def dashboard_command(message: types.Message):
+    await send_dashboard(message)
 
-    except Exception as e:
-        logging.error(f"Ошибка при построении графика для {coin} с интервалом 1d: {e}")
-        await callback_query.message.answer(f"Ошибка при построении графика для {coin}. Пожалуйста, попробуйте позже.")
 
-    # После отправки графика, покажем пользователю кнопки для выбора временного интервала снова
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("Показать график", callback_data=f"chart_{coin}"))
-    markup.add(InlineKeyboardButton("1 час", callback_data=f"interval_1h_{coin}"))
-    markup.add(InlineKeyboardButton("1 день", callback_data=f"interval_1d_{coin}"))
-    markup.add(InlineKeyboardButton("1 неделя", callback_data=f"interval_1w_{coin}"))
-    # ... добавьте другие интервалы по желанию ...
-
-    await callback_query.message.answer("Выберите временной интервал для графика:", reply_markup=markup)
-    await callback_query.answer()
-    # После отправки графика, отправляем пользователю основное меню
-    await callback_query.message.answer("Выберите действие из меню:", reply_markup=menu)
+@dp.callback_query_handler(lambda c: c.data == 'menu_dashboard')
+async def dashboard_menu_handler(callback_query: types.CallbackQuery):
+    await send_dashboard(callback_query.message)
     await callback_query.answer()
 
 
+async def send_dashboard(message: types.Message):
+    """Одно изображение со спарклайнами, ценой и изменением за 24 часа для всех монет из get_listed_coins."""
+    coins = await get_listed_coins()
 
+    async def produce():
+        symbols = [f'{coin}/USDT' for coin in coins]
+        # Тикеры - одним запросом, свечи для спарклайнов - параллельно
+        tickers, *candles = await asyncio.gather(
+            exchange.fetch_tickers(symbols),
+            *(exchange.fetch_ohlcv(symbol, DASHBOARD_TIMEFRAME, limit=DASHBOARD_CANDLES) for symbol in symbols),
+            return_exceptions=True)
+        if isinstance(tickers, Exception):
+            raise tickers
+        panels = []
+        for coin, symbol, ohlcv in zip(coins, symbols, candles):
+            if (isinstance(ohlcv, Exception) or not ohlcv or symbol not in tickers
+                    or tickers[symbol].get('last') is None):
+                reason = ohlcv if isinstance(ohlcv, Exception) else "нет свечей, тикера или последней цены"
+                logging.error(f"Нет данных для дашборда по {symbol}: {reason}")
+                continue
+            panels.append((coin, [candle[4] for candle in ohlcv], tickers[symbol]['last'],
+                           tickers[symbol].get('percentage') or 0.0))
+        image = await chart_service.render(render_dashboard, panels)
+        return image, f"Рынок за 24 часа: {len(panels)} монет"
 
+    try:
+        await send_cached_chart(message, (tuple(coins), DASHBOARD_TIMEFRAME,
+                                          current_candle_open(DASHBOARD_TIMEFRAME), 'dashboard'), produce)
+    except Exception as e:
+        logging.error(f"Ошибка при построении дашборда: {e}")
+        await message.answer("Ошибка при построении дашборда. Пожалуйста, попробуйте позже.")
+    await show_menu_after_request(message)
 
 
 @dp.callback_query_handler(lambda c: c.data == 'menu_tradehistory')
 async def menu_tradehistory_handler(callback_query: types.CallbackQuery):
     try:
-        trades = await exchange.fetch_my_trades('BTC/USDT', limit=5)  # последние 5 сделок
+        # Пока поток подключен, сделки по TRADE_HISTORY_SYMBOLS есть в памяти (снимок и события потока)
+        if account_state.ready and 'BTC/USDT' in user_data_stream.fill_symbols:
+            trades = account_state.recent_fills('BTC/USDT', limit=5)
+        else:
+            trades = await exchange.fetch_my_trades('BTC/USDT', limit=5)  # последние 5 сделок
+            balance_cache.observe_trades(trades)
         trade_messages = [f"Сделка {trade['id']}: {trade['amount']} BTC по цене {trade['price']} USDT" for trade in trades]
         await callback_query.message.answer("\n".join(trade_messages))
         await show_menu_after_request(callback_query.message)
@@ -900,6 +3331,248 @@ async def menu_tradehistory_handler(callback_query: types.CallbackQuery):
     await callback_query.answer()
 
 
+class BacktestQuery(StatesGroup):
+    coin = State()
+    timeframe = State()
+    strategy = State()
+    range = State()
+
+
+# Стратегии для /backtest: ключ -> (название, метод MarketAnalysis с сигналами по барам)
+BACKTEST_STRATEGIES = {
+    'combined': ("Combined (MACD + RSI + Bollinger)", 'combined_strategy_signals'),
+    'rsimacd': ("RSI + MACD", 'analyze_data_signals'),
+}
+BACKTEST_TIMEFRAMES = ['15m', '1h', '4h', '1d']
+BACKTEST_RANGES = [500, 1000, 2000, 5000]
+BACKTEST_INITIAL_BALANCE = 10000
+
+# Бэктесты считаются в отдельных процессах, чтобы не блокировать обработку сообщений
+backtest_executor = ProcessPoolExecutor(max_workers=int(os.getenv('BACKTEST_WORKERS', 2)), mp_context=WORKER_MP_CONTEXT)
+# Ключ - ID пользователя, значение - (asyncio.Task, событие отмены для процесса-исполнителя)
+backtest_jobs = {}
+_backtest_manager = None
+
+
+def backtest_cancel_event():
+    """Событие отмены, которое можно передать в процесс-исполнитель (через процесс-менеджер)."""
+    global _backtest_manager
+    if _backtest_manager is None:
+        _backtest_manager = WORKER_MP_CONTEXT.Manager()
+    return _backtest_manager.Event()
+
+
+class ProgressMessage:
+    """Сообщение о ходе длительной операции, которое редактируется вместо отправки новых сообщений."""
+
+    def __init__(self, message, reply_markup=None, min_interval=1.0):
+        self.message = message
+        self.reply_markup = reply_markup
+        self.min_interval = min_interval
+        self._text = message.text
+        self._edited_at = 0
+
+    async def update(self, text, final=False, force=False):
+        """
+        :param final: Последнее состояние: кнопки убираются.
+        :param force: Показать сразу, без ограничения частоты (final подразумевает force).
+        """
+        # Telegram ограничивает частоту редактирования, промежуточные состояния можно пропускать
+        if text == self._text or (not (final or force) and time.monotonic() - self._edited_at < self.min_interval):
+            return
+        try:
+            await self.message.edit_text(text, reply_markup=None if final else self.reply_markup)
+        except MessageNotModified:
+            pass
+        self._text = text
+        self._edited_at = time.monotonic()
+
+
+async def ask_backtest_coin(message: types.Message):
+    await BacktestQuery.coin.set()
+    await message.answer("Введите монету для бэктеста (например, BTC):",
+                         reply_markup=InlineKeyboardMarkup().add(cancel_button))
+
+
+@dp.message_handler(commands=['backtest'])
+async def backtest_command(message: types.Message):
+    await ask_backtest_coin(message)
+
+
+@dp.callback_query_handler(lambda c: c.data == 'menu_backtest')
+async def backtest_menu_handler(callback_query: types.CallbackQuery):
+    await ask_backtest_coin(callback_query.message)
+    await callback_query.answer()
+
+
+@dp.message_handler(state=BacktestQuery.coin)
+async def backtest_coin_input(message: types.Message, state: FSMContext):
+    await state.update_data({"coin": message.text.strip().upper()})
+    markup = InlineKeyboardMarkup(row_width=4)
+    markup.add(*(InlineKeyboardButton(timeframe, callback_data=f"bt_tf_{timeframe}")
+                 for timeframe in BACKTEST_TIMEFRAMES))
+    markup.add(cancel_button)
+    await message.answer("Выберите таймфрейм:", reply_markup=markup)
+    await BacktestQuery.next()
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bt_tf_'), state=BacktestQuery.timeframe)
+async def backtest_timeframe_chosen(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.update_data({"timeframe": callback_query.data[len('bt_tf_'):]})
+    markup = InlineKeyboardMarkup(row_width=1)
+    for key, (title, _) in BACKTEST_STRATEGIES.items():
+        markup.add(InlineKeyboardButton(title, callback_data=f"bt_strategy_{key}"))
+    markup.add(cancel_button)
+    await callback_query.message.answer("Выберите стратегию:", reply_markup=markup)
+    await BacktestQuery.next()
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bt_strategy_'), state=BacktestQuery.strategy)
+async def backtest_strategy_chosen(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.update_data({"strategy": callback_query.data[len('bt_strategy_'):]})
+    markup = InlineKeyboardMarkup(row_width=4)
+    markup.add(*(InlineKeyboardButton(str(candles), callback_data=f"bt_range_{candles}")
+                 for candles in BACKTEST_RANGES))
+    markup.add(cancel_button)
+    await callback_query.message.answer("Выберите количество свечей истории:", reply_markup=markup)
+    await BacktestQuery.next()
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith('bt_range_'), state=BacktestQuery.range)
+async def backtest_range_chosen(callback_query: types.CallbackQuery, state: FSMContext):
+    params = await state.get_data()
+    await state.finish()
+    user_id = callback_query.from_user.id
+    cancel_backtest_job(user_id)
+    cancel_event = backtest_cancel_event()
+    backtest_jobs[user_id] = (asyncio.create_task(run_backtest_job(
+        callback_query.message, user_id, params['coin'], params['timeframe'], params['strategy'],
+        int(callback_query.data[len('bt_range_'):]), cancel_event)), cancel_event)
+    await callback_query.answer()
+
+
+def cancel_backtest_job(user_id):
+    """Прерывает выполняемый бэктест пользователя. Возвращает True, если было что отменять."""
+    job = backtest_jobs.pop(user_id, None)
+    if job is None or job[0].done():
+        return False
+    task, cancel_event = job
+    # Отмена задачи прекращает только ожидание, расчет в процессе-исполнителе останавливает событие
+    cancel_event.set()
+    task.cancel()
+    return True
+
+
+async def fetch_ohlcv_history(symbol, timeframe, candles, on_chunk=None):
+    """
+    Загружает последние candles свечей частями по 1000 (ограничение Binance на один запрос).
+
+    :param on_chunk: Корутина-функция (загружено, всего), вызываемая после каждой части.
+    """
+    timeframe_ms = exchange.parse_timeframe(timeframe) * 1000
+    since = exchange.milliseconds() - candles * timeframe_ms
+    rows = []
+    while len(rows) < candles:
+        limit = min(1000, candles - len(rows))
+        chunk = await exchange.fetch_ohlcv(symbol, timeframe, since=since, limit=limit)
+        if not chunk:
+            break
+        rows.extend(chunk)
+        since = chunk[-1][0] + timeframe_ms
+        if on_chunk is not None:
+            await on_chunk(len(rows), candles)
+        if len(chunk) < limit:
+            break
+    return rows
+
+
+async def run_backtest_job(message: types.Message, user_id, coin, timeframe, strategy_name, candles,
+                           cancel_event=None):
+    symbol = f'{coin}/USDT'
+    title = f"Бэктест {symbol} {timeframe}, {BACKTEST_STRATEGIES[strategy_name][0]}"
+    progress = ProgressMessage(await message.answer(f"{title}\nЗагрузка свечей: 0/{candles}",
+                                                    reply_markup=InlineKeyboardMarkup().add(cancel_button)),
+                               reply_markup=InlineKeyboardMarkup().add(cancel_button))
+    try:
+        async def on_chunk(loaded, total):
+            await progress.update(f"{title}\nЗагрузка свечей: {loaded}/{total}")
+
+        ohlcv = await fetch_ohlcv_history(symbol, timeframe, candles, on_chunk)
+        if len(ohlcv) < 2:
+            await progress.update(f"{title}\nНедостаточно данных для бэктеста.", final=True)
+            return
+
+        await progress.update(f"{title}\nЗагружено свечей: {len(ohlcv)}. Расчет...", force=True)
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(backtest_executor, _run_backtest_job, ohlcv, symbol, timeframe,
+                                            strategy_name, cancel_event)
+
+        await progress.update(f"{title}\nГотово.", final=True)
+        await message.answer_photo(chart_input_file(report['chart']), caption=format_backtest_report(title, report))
+        await show_menu_after_request(message)
+    except asyncio.CancelledError:
+        await progress.update(f"{title}\nБэктест отменен.", final=True)
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении бэктеста {symbol} {timeframe}: {e}")
+        await progress.update(f"{title}\nОшибка при выполнении бэктеста. Пожалуйста, попробуйте позже.", final=True)
+    finally:
+        if backtest_jobs.get(user_id, (None,))[0] is asyncio.current_task():
+            del backtest_jobs[user_id]
+
+
+def _run_backtest_job(ohlcv, symbol, timeframe, strategy_name, cancel_event=None):
+    """
+    Выполняет бэктест в процессе-исполнителе и возвращает сводку и график капитала.
+
+    Если cancel_event установлен, расчет прерывается (BacktestCancelled) внутри бэктеста или между этапами.
+    """
+    analyzer = MarketAnalysis(None, None)
+    data = ohlcv_to_dataframe(ohlcv)
+    strategy = getattr(analyzer, BACKTEST_STRATEGIES[strategy_name][1])
+    # Объем позиции подбирается так, чтобы даже по максимальной цене позиция не превышала стартовый баланс
+    trade_size = BACKTEST_INITIAL_BALANCE / data['Close'].max()
+    # Если для пары записывался стакан, исполнение учитывает проскальзывание по нему
+    slippage_model = OrderBookSlippageModel.for_symbol(os.path.join(DATA_DIR, 'orderbooks'), symbol)
+    result = analyzer.cached_backtesting(strategy, data, symbol, timeframe, cancel_event=cancel_event,
+                                         initial_balance=BACKTEST_INITIAL_BALANCE, trade_size=trade_size,
+                                         slippage_model=slippage_model)
+    if cancel_event is not None and cancel_event.is_set():
+        raise BacktestCancelled()
+    return {
+        "start": data.index[0],
+        "end": data.index[-1],
+        "candles": len(data),
+        "profit": result['profit'],
+        "metrics": result['metrics'],
+        "monte_carlo": analyzer.monte_carlo_analysis(result, n_simulations=2000) if result['closed_trades'] else None,
+        "chart": render_equity_chart(result['trades']['Equity'], f"{symbol} {timeframe}"),
+    }
+
+
+def format_backtest_report(title, report):
+    metrics = report['metrics']
+    lines = [
+        title,
+        f"Период: {report['start']:%Y-%m-%d %H:%M} - {report['end']:%Y-%m-%d %H:%M} ({report['candles']} свечей)",
+        f"Прибыль: {report['profit']:.2f} USDT ({report['profit'] / BACKTEST_INITIAL_BALANCE * 100:.2f}%)",
+        f"Сделок: {metrics['trades']}, прибыльных: {metrics['win_rate'] * 100:.1f}%, "
+        f"в позиции {metrics['exposure'] * 100:.1f}% времени",
+        f"Sharpe: {metrics['sharpe']:.2f}, Sortino: {metrics['sortino']:.2f}, "
+        f"макс. просадка: {metrics['max_drawdown'] * 100:.1f}%",
+    ]
+    monte_carlo = report['monte_carlo']
+    if monte_carlo is not None and monte_carlo['status'] == 'success':
+        lines.append(
+            f"Monte Carlo ({monte_carlo['simulations']}): медианная доходность "
+            f"{monte_carlo['return_percentiles'][50] * 100:.1f}%, вероятность убытка "
+            f"{monte_carlo['probability_of_loss'] * 100:.1f}%, просадка в 5% худших случаев "
+            f"{monte_carlo['max_drawdown_percentiles'][95] * 100:.1f}%")
+    return "\n".join(lines)
+
+
 class PriceAlert(StatesGroup):
     setting_coins = State()
     setting_prices = State()
@@ -962,6 +3635,7 @@ async def set_price_alerts(message: types.Message, state: FSMContext):
 @dp.callback_query_handler(lambda c: c.data == "cancel_action", state='*')
 async def cancel_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await state.finish()
+    cancel_backtest_job(callback_query.from_user.id)
     await callback_query.message.answer("Действие отменено.")
     # После отправки графика, отправляем пользователю основное меню
     await callback_query.message.answer("Выберите действие из меню:", reply_markup=menu)
@@ -1027,5 +3701,13 @@ async def check_price_alerts():
 
 
 if __name__ == '__main__':
+    import sys
+    if '--benchmark-charts' in sys.argv:
+        for chart, stats in benchmark_charts().items():
+            print(f"{chart:<12} {stats['renders_per_sec']:7.1f} renders/s {stats['ms_per_render']:8.1f} ms "
+                  f"{stats['kb_per_render']:9.0f} KB  open figures: {stats['open_figures']}")
+        sys.exit()
     from aiogram import executor
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
\ No newline at end of file
+    # Точка входа бота. on_shutdown сбрасывает журнал истории баланса в блок при остановке,
+    # иначе последние точки до полного блока восстанавливаются из журнала только при следующем запуске
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)
\ No newline at end of file
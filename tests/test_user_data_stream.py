@@ -0,0 +1,76 @@
+"""Проверки AccountState и UserDataStream на MockUserDataStream, без биржи."""
+import asyncio
+
+from bot import AccountState, MockUserDataStream
+
+SNAPSHOT = {'free': {'USDT': 100.0}, 'used': {'USDT': 0.0}, 'total': {'USDT': 100.0}}
+OPEN_ORDER = {'id': '1', 'symbol': 'ETH/USDT', 'side': 'sell', 'type': 'limit', 'price': 4000.0, 'amount': 1.0,
+              'filled': 0.0, 'timestamp': 0, 'info': {'status': 'NEW'}}
+SNAPSHOT_TRADE = {'id': 9, 'order': '7', 'symbol': 'BTC/USDT', 'side': 'buy', 'amount': 0.002, 'price': 59000.0,
+                  'cost': 118.0, 'fee': None, 'timestamp': 0}
+ORDER = {'e': 'executionReport', 'E': 1, 's': 'BTCUSDT', 'c': 'c1', 'S': 'BUY', 'o': 'LIMIT', 'q': '0.001',
+         'p': '60000', 'X': 'NEW', 'x': 'NEW', 'i': 2, 'z': '0', 'O': 1, 't': -1, 'l': '0', 'L': '0',
+         'Y': '0', 'n': '0', 'N': None, 'T': 1}
+TRADE = {**ORDER, 'E': 2, 'X': 'FILLED', 'x': 'TRADE', 'z': '0.001', 't': 10, 'l': '0.001', 'L': '60000', 'Y': '60',
+         'n': '0.00001', 'N': 'BNB', 'T': 2}
+
+
+def make_stream(fills):
+    state = AccountState(lambda market_id: market_id[:-4] + '/' + market_id[-4:])
+    stream = MockUserDataStream(state, SNAPSHOT, open_orders=[OPEN_ORDER], fills=[SNAPSHOT_TRADE],
+                                on_fill=fills.append)
+    return state, stream
+
+
+def test_snapshot_and_events():
+    async def scenario():
+        fills = []
+        state, stream = make_stream(fills)
+        task = asyncio.create_task(stream.run())
+        try:
+            await asyncio.sleep(0.05)
+            assert state.ready and state.totals() == {'USDT': 100.0}
+            assert set(state.open_orders) == {'1'}
+            assert [fill['id'] for fill in state.recent_fills('BTC/USDT')] == ['9']
+
+            stream.push(ORDER)
+            await asyncio.sleep(0.05)
+            assert set(state.open_orders) == {'1', '2'}
+
+            stream.push(TRADE)
+            # Повтор той же сделки (она уже могла попасть в снимок) не дублируется
+            stream.push(TRADE)
+            stream.push({'e': 'outboundAccountPosition', 'E': 3, 'B': [{'a': 'BTC', 'f': '0.001', 'l': '0'},
+                                                                       {'a': 'USDT', 'f': '40', 'l': '0'}]})
+            await asyncio.sleep(0.05)
+            assert set(state.open_orders) == {'1'}
+            assert [fill['id'] for fill in state.recent_fills('BTC/USDT')] == ['9', '10']
+            assert [fill['id'] for fill in fills] == ['10']
+            assert state.totals() == {'USDT': 40.0, 'BTC': 0.001}
+        finally:
+            task.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_reconnect_reloads_snapshot():
+    async def scenario():
+        state, stream = make_stream([])
+        task = asyncio.create_task(stream.run())
+        try:
+            await asyncio.sleep(0.05)
+            stream.push(TRADE)
+            await asyncio.sleep(0.05)
+            stream.close()
+            await asyncio.sleep(0.05)
+            assert not state.ready
+
+            # Переподключение - после паузы в 1 секунду
+            await asyncio.sleep(1.2)
+            assert state.ready and stream.connections == 2
+            assert state.totals() == {'USDT': 100.0}
+            assert [fill['id'] for fill in state.recent_fills()] == ['9']
+        finally:
+            task.cancel()
+
+    asyncio.run(scenario())